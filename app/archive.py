@@ -0,0 +1,335 @@
+import asyncio
+import bisect
+import datetime
+import gzip
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from typing import Callable, Dict, Iterator, List, Optional
+
+from .db import (
+    DEFAULT_CURRENCY,
+    EXPORT_COLUMNS,
+    acquire_lease,
+    delete_transactions,
+    get_archivable_transactions,
+    get_transactions_page,
+    iter_transactions,
+    rollup_outcome,
+)
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_SEGMENT_ROWS = int(os.getenv("ARCHIVE_SEGMENT_ROWS", "50000"))
+
+ARCHIVE_COLUMNS = (
+    "id", "order_id", "amount", "description", "status", "created_at", "idempotency_key", "redirect_uri", "pos_id",
+    "currency",
+)
+ArchivedTransaction = namedtuple("ArchivedTransaction", ARCHIVE_COLUMNS)
+
+_SEGMENT_SUFFIX = ".ndjson.gz"
+_INDEX_SUFFIX = ".index.json"
+
+
+def _matches(row: ArchivedTransaction, filters: Dict) -> bool:
+    # Same semantics as db.transaction_filters.
+    if filters.get("status") and row.status != filters["status"]:
+        return False
+    if filters.get("order_id") and row.order_id != filters["order_id"]:
+        return False
+    if filters.get("min_amount") is not None and (row.amount is None or row.amount < filters["min_amount"]):
+        return False
+    if filters.get("max_amount") is not None and (row.amount is None or row.amount > filters["max_amount"]):
+        return False
+    if filters.get("created_from") is not None and row.created_at < filters["created_from"]:
+        return False
+    if filters.get("created_to") is not None and row.created_at >= filters["created_to"]:
+        return False
+    return True
+
+
+class SegmentStore:
+    # Cold storage for archived payment_transactions: append-only gzip NDJSON
+    # segments, oldest first, each with a JSON index beside it (row count,
+    # created_at/id/amount ranges, statuses and the sorted order_ids). The
+    # index is written last, so a segment without one is ignored. Searches
+    # skip segments whose index rules them out before decompressing anything.
+    def __init__(self, path: str = ARCHIVE_DIR, cache_segments: int = 4):
+        self.path = path
+        self.cache_segments = cache_segments
+        self._summaries: Optional[List[Dict]] = None
+        # Sorted order_ids per segment, loaded with the summaries.
+        self._order_ids: Dict[str, List[str]] = {}
+        self._stamp = None
+        self._cache: "OrderedDict[str, List[ArchivedTransaction]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _file(self, name: str, suffix: str) -> str:
+        return os.path.join(self.path, name + suffix)
+
+    def segments(self) -> List[Dict]:
+        # Index summaries, oldest first; reloaded when the directory changes.
+        # Indexes already loaded are kept, since segments are never rewritten.
+        try:
+            stamp = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        with self._lock:
+            if self._summaries is None or stamp != self._stamp:
+                known = {s["name"]: s for s in self._summaries or ()}
+                summaries, order_ids = [], {}
+                for filename in os.listdir(self.path):
+                    if not filename.endswith(_INDEX_SUFFIX):
+                        continue
+                    name = filename[:-len(_INDEX_SUFFIX)]
+                    index = known.get(name)
+                    if index is None:
+                        with open(os.path.join(self.path, filename)) as f:
+                            index = json.load(f)
+                        self._order_ids[name] = index.pop("order_ids", [])
+                        for key in ("min_created_at", "max_created_at"):
+                            index[key] = datetime.datetime.fromisoformat(index[key])
+                    summaries.append(index)
+                    order_ids[name] = self._order_ids[name]
+                summaries.sort(key=lambda s: (s["min_created_at"], s["min_id"]))
+                self._summaries, self._order_ids, self._stamp = summaries, order_ids, stamp
+            return self._summaries
+
+    def write(self, rows) -> Dict:
+        # rows: oldest first, as returned by db.get_archivable_transactions.
+        records = [ArchivedTransaction(*(getattr(row, c) for c in ARCHIVE_COLUMNS)) for row in rows]
+        name = f"tx-{records[0].id:012d}-{records[-1].id:012d}"
+        os.makedirs(self.path, exist_ok=True)
+        body = "".join(
+            json.dumps(
+                {c: (v.isoformat() if c == "created_at" else v) for c, v in zip(ARCHIVE_COLUMNS, record)},
+                ensure_ascii=False,
+            ) + "\n"
+            for record in records
+        )
+        index = {
+            "name": name,
+            "rows": len(records),
+            "min_created_at": records[0].created_at.isoformat(),
+            "max_created_at": records[-1].created_at.isoformat(),
+            "min_id": min(r.id for r in records),
+            "max_id": max(r.id for r in records),
+            "min_amount": min((r.amount for r in records if r.amount is not None), default=None),
+            "max_amount": max((r.amount for r in records if r.amount is not None), default=None),
+            "statuses": sorted({r.status for r in records if r.status is not None}),
+            "order_ids": sorted({r.order_id for r in records if r.order_id}),
+        }
+        self._write_atomic(self._file(name, _SEGMENT_SUFFIX), gzip.compress(body.encode(), mtime=0))
+        self._write_atomic(self._file(name, _INDEX_SUFFIX), json.dumps(index).encode())
+        return index
+
+    def _write_atomic(self, path: str, data: bytes) -> None:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def read(self, name: str) -> List[ArchivedTransaction]:
+        with self._lock:
+            rows = self._cache.get(name)
+            if rows is not None:
+                self._cache.move_to_end(name)
+                return rows
+        with gzip.open(self._file(name, _SEGMENT_SUFFIX), "rt", encoding="utf-8") as f:
+            rows = []
+            for line in f:
+                record = json.loads(line)
+                record["created_at"] = datetime.datetime.fromisoformat(record["created_at"])
+                # Segments written before currencies were recorded.
+                record.setdefault("currency", DEFAULT_CURRENCY)
+                rows.append(ArchivedTransaction(**record))
+        with self._lock:
+            self._cache[name] = rows
+            while len(self._cache) > self.cache_segments:
+                self._cache.popitem(last=False)
+        return rows
+
+    def _may_contain(self, summary: Dict, filters: Dict) -> bool:
+        if filters.get("created_from") is not None and summary["max_created_at"] < filters["created_from"]:
+            return False
+        if filters.get("created_to") is not None and summary["min_created_at"] >= filters["created_to"]:
+            return False
+        if filters.get("status") and filters["status"] not in summary["statuses"]:
+            return False
+        if filters.get("min_amount") is not None and (summary["max_amount"] or 0) < filters["min_amount"]:
+            return False
+        if filters.get("max_amount") is not None and (summary["min_amount"] or 0) > filters["max_amount"]:
+            return False
+        if filters.get("order_id"):
+            order_ids = self._order_ids.get(summary["name"], ())
+            i = bisect.bisect_left(order_ids, filters["order_id"])
+            return i < len(order_ids) and order_ids[i] == filters["order_id"]
+        return True
+
+    def iter_rows(self, newest_first: bool = False, before=None, **filters) -> Iterator[ArchivedTransaction]:
+        # Matching rows in (created_at, id) order; `before` is a keyset cursor
+        # for newest-first reads.
+        summaries = self.segments()
+        if newest_first:
+            summaries = reversed(summaries)
+        for summary in summaries:
+            if before is not None and summary["min_created_at"] > before[0]:
+                continue
+            if not self._may_contain(summary, filters):
+                continue
+            rows = self.read(summary["name"])
+            for row in reversed(rows) if newest_first else rows:
+                if before is not None and (row.created_at, row.id) >= before:
+                    continue
+                if _matches(row, filters):
+                    yield row
+
+    def archived_ids(self, summary: Dict) -> List[int]:
+        return [row.id for row in self.read(summary["name"])]
+
+
+def search_transactions(store: SegmentStore, limit=50, after=None, **filters):
+    # get_transactions_page over the hot table, continued into the archive.
+    # Every archived row is older than every hot row (archival goes by age),
+    # so the archive simply follows the last hot page.
+    txs, next_cursor = get_transactions_page(limit=limit, after=after, **filters)
+    if next_cursor is not None:
+        return txs, next_cursor
+    before = (txs[-1].created_at, txs[-1].id) if txs else after
+    for row in store.iter_rows(newest_first=True, before=before, **filters):
+        txs.append(row)
+        if len(txs) > limit:
+            txs = txs[:limit]
+            return txs, (txs[-1].created_at, txs[-1].id)
+    return txs, None
+
+
+def iter_all_transactions(store: SegmentStore, chunk_size=1000, **filters):
+    # db.iter_transactions preceded by the archived rows, oldest first.
+    chunk = []
+    for row in store.iter_rows(**filters):
+        chunk.append(tuple(getattr(row, c) for c in EXPORT_COLUMNS))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+    yield from iter_transactions(chunk_size=chunk_size, **filters)
+
+
+def finish_interrupted_archival(store: SegmentStore) -> None:
+    # A crash between writing a segment and deleting its rows leaves them in
+    # both places; finishes the delete.
+    segments = store.segments()
+    if segments:
+        delete_transactions(store.archived_ids(segments[-1]))
+
+
+def archived_rollups(store: SegmentStore) -> List[Dict]:
+    # revenue_rollups rows for everything in the archive, for
+    # db.rebuild_revenue_rollups. Reads every segment.
+    totals: Dict[tuple, List[int]] = {}
+    for row in store.iter_rows():
+        key = (row.created_at.strftime("%Y-%m-%d %H:00"), row.currency, rollup_outcome(row.status))
+        entry = totals.setdefault(key, [0, 0])
+        entry[0] += 1
+        entry[1] += row.amount or 0
+    return [
+        {"hour": hour, "currency": currency, "outcome": outcome, "orders": orders, "amount": amount}
+        for (hour, currency, outcome), (orders, amount) in totals.items()
+    ]
+
+
+def archive_transactions(
+    store: SegmentStore,
+    created_before,
+    segment_rows: int = ARCHIVE_SEGMENT_ROWS,
+    keep_lease: Optional[Callable[[], bool]] = None,
+) -> int:
+    # Moves rows created before `created_before` into new segments, one
+    # segment per `segment_rows` rows. keep_lease() is called before each
+    # segment; the pass stops once it returns False. Returns the number of
+    # rows moved.
+    finish_interrupted_archival(store)
+    moved = 0
+    while True:
+        if keep_lease is not None and not keep_lease():
+            break
+        rows = get_archivable_transactions(created_before, limit=segment_rows)
+        if not rows:
+            break
+        store.write(rows)
+        delete_transactions([row.id for row in rows])
+        moved += len(rows)
+        if len(rows) < segment_rows:
+            break
+    return moved
+
+
+class Archiver:
+    # Periodically archives rows older than `after_days`. Only the worker
+    # holding the "archiver" lease runs a pass.
+    def __init__(
+        self,
+        store: SegmentStore,
+        *,
+        interval: float = 86400.0,
+        after_days: float = ARCHIVE_AFTER_DAYS,
+        lease_ttl: float = 300.0,
+    ):
+        self.store = store
+        self.interval = interval
+        self.after_days = after_days
+        self.lease_ttl = lease_ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._task: Optional[asyncio.Task] = None
+        self.last_run: Dict[str, object] = {}
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Transaction archival pass failed")
+            await asyncio.sleep(self.interval)
+
+    def _hold_lease(self) -> bool:
+        # Renewed before every segment, so it only has to outlive writing one;
+        # if the owner dies, another worker can take over soon after.
+        return acquire_lease("archiver", self.owner, self.lease_ttl)
+
+    async def run_once(self) -> Dict[str, object]:
+        if not await asyncio.to_thread(self._hold_lease):
+            return {}
+        started = time.monotonic()
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=self.after_days)
+        moved = await asyncio.to_thread(archive_transactions, self.store, cutoff, keep_lease=self._hold_lease)
+        self.last_run = {"at": cutoff, "moved": moved, "duration_s": round(time.monotonic() - started, 3)}
+        if moved:
+            logger.info("Archived %d transactions created before %s", moved, cutoff.isoformat())
+        return self.last_run
@@ -0,0 +1,40 @@
+import asyncio
+from typing import Any, List, Optional, Tuple
+
+# Put on a queue to make the consumer flush what it has and exit.
+STOP = object()
+
+
+async def collect_batch(
+    queue: asyncio.Queue,
+    batch_size: int,
+    flush_interval: float,
+    idle_timeout: Optional[float] = None,
+) -> Tuple[List[Any], bool]:
+    # Waits for one item (at most idle_timeout seconds, if given), then keeps
+    # collecting until batch_size items are in hand or flush_interval seconds
+    # have passed. Returns (batch, stopping).
+    loop = asyncio.get_running_loop()
+    try:
+        item = await asyncio.wait_for(queue.get(), idle_timeout)
+    except asyncio.TimeoutError:
+        return [], False
+    if item is STOP:
+        return [], True
+    batch = [item]
+    deadline = loop.time() + flush_interval
+    while len(batch) < batch_size:
+        try:
+            item = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+        if item is STOP:
+            return batch, True
+        batch.append(item)
+    return batch, False
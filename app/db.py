@@ -1,8 +1,22 @@
-from sqlalchemy import Column, String, create_engine
+import os
+import time
+
+from . import metrics
+
+from sqlalchemy import Column, String, bindparam, create_engine, event, inspect, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from .dbwriter import SerialWriter
 
 DB_PATH = "sqlite:///settings.db"
+# Touched on every settings write so other workers know to reload their cache.
+SETTINGS_VERSION_FILE = "settings.db.version"
+SETTINGS_CHECK_INTERVAL = 1.0
+# Currency of the default POS; rows stored before currencies were recorded are in it.
+DEFAULT_CURRENCY = "PLN"
 Base = declarative_base()
 
 class Settings(Base):
@@ -11,48 +25,579 @@ class Settings(Base):
     value = Column(String)
 
 
-from sqlalchemy import Integer, DateTime
+from sqlalchemy import Integer, DateTime, Float, Index, and_, func, or_, select
 import datetime
 
 class PaymentTransaction(Base):
     __tablename__ = "payment_transactions"
+    __table_args__ = (
+        Index("ix_payment_transactions_created_at_id", "created_at", "id"),
+        Index("ix_payment_transactions_status_created_at_id", "status", "created_at", "id"),
+        Index("ix_payment_transactions_order_id", "order_id"),
+        Index("ux_payment_transactions_idempotency_key", "idempotency_key", unique=True),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     order_id = Column(String)
     amount = Column(Integer)
+    # ISO 4217 code; `amount` is in its minor units.
+    currency = Column(String, server_default=DEFAULT_CURRENCY)
     description = Column(String)
     status = Column(String)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # Set only on successfully created orders, so a failed attempt can be retried.
+    idempotency_key = Column(String)
+    redirect_uri = Column(String)
+    # PayU POS that created the order (NULL: the default POS).
+    pos_id = Column(String)
+
+class Lease(Base):
+    # Lets one worker process run a background job at a time.
+    __tablename__ = "leases"
+    name = Column(String, primary_key=True)
+    owner = Column(String)
+    expires_at = Column(Float)
+
+class RevokedSession(Base):
+    # Logged-out admin sessions, kept until their tokens would have expired.
+    __tablename__ = "revoked_sessions"
+    session_id = Column(String, primary_key=True)
+    expires_at = Column(Float, nullable=False)
+
+class RevenueRollup(Base):
+    # Per-hour (UTC) order count and amount per currency and outcome, kept
+    # current by triggers on payment_transactions so the dashboard never scans it.
+    __tablename__ = "revenue_rollups"
+    hour = Column(String, primary_key=True)
+    currency = Column(String, primary_key=True)
+    outcome = Column(String, primary_key=True)
+    orders = Column(Integer, nullable=False, default=0)
+    amount = Column(Integer, nullable=False, default=0)
+
+# Outcome buckets for a transaction status. "SUCCESS" is what /pay records for
+# a created order; anything not listed (error messages) counts as an error.
+ROLLUP_OUTCOMES = ("pending", "completed", "canceled", "error")
+_PENDING_STATUSES = ("SUCCESS", "NEW", "PENDING", "WAITING_FOR_CONFIRMATION")
+
+def _rollup_outcome_sql(status):
+    pending = ", ".join(f"'{s}'" for s in _PENDING_STATUSES)
+    return (
+        f"CASE WHEN {status} IN ({pending}) THEN 'pending' "
+        f"WHEN {status} = 'COMPLETED' THEN 'completed' "
+        f"WHEN {status} = 'CANCELED' THEN 'canceled' ELSE 'error' END"
+    )
+
+def rollup_outcome(status):
+    # _rollup_outcome_sql for rows outside the table (the archive).
+    if status in _PENDING_STATUSES:
+        return "pending"
+    if status == "COMPLETED":
+        return "completed"
+    if status == "CANCELED":
+        return "canceled"
+    return "error"
+
+def _rollup_currency_sql(currency):
+    return f"COALESCE({currency}, '{DEFAULT_CURRENCY}')"
+
+def _rollup_upsert_sql(row, sign):
+    return (
+        "INSERT INTO revenue_rollups (hour, currency, outcome, orders, amount) VALUES ("
+        f"strftime('%Y-%m-%d %H:00', {row}.created_at), {_rollup_currency_sql(row + '.currency')}, "
+        f"{_rollup_outcome_sql(row + '.status')}, {sign}1, {sign}COALESCE({row}.amount, 0)) "
+        "ON CONFLICT (hour, currency, outcome) DO UPDATE SET "
+        "orders = orders + excluded.orders, amount = amount + excluded.amount;"
+    )
+
+# Rows are deliberately not subtracted on DELETE: pruning or archiving old
+# transactions keeps their history on the dashboard.
+# Recreated on every migration, so changes to their bodies take effect.
+_ROLLUP_TRIGGERS = {
+    "payment_transactions_rollup_insert":
+        "AFTER INSERT ON payment_transactions BEGIN "
+        + _rollup_upsert_sql("NEW", "") + " END",
+    "payment_transactions_rollup_update":
+        "AFTER UPDATE OF status, amount, currency, created_at ON payment_transactions BEGIN "
+        + _rollup_upsert_sql("OLD", "-") + " " + _rollup_upsert_sql("NEW", "") + " END",
+}
+
+# Storage tuning. WAL lets readers run alongside the (single) writer; NORMAL
+# sync is durable across application crashes and only fsyncs on checkpoints.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "10"))
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL").upper()
+DB_CACHE_SIZE = int(os.getenv("DB_CACHE_SIZE", "-16000"))  # negative: KiB
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(128 * 1024 * 1024)))
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH", "64"))
+
+if DB_SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    raise ValueError(f"Invalid DB_SYNCHRONOUS: {DB_SYNCHRONOUS}")
+
+def _make_engine(pool_size, max_overflow):
+    return create_engine(
+        DB_PATH,
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=DB_POOL_TIMEOUT,
+        # The sqlite3 timeout is its busy handler: wait for another process's
+        # write lock instead of failing with "database is locked".
+        connect_args={"check_same_thread": False, "timeout": DB_BUSY_TIMEOUT},
+    )
 
-engine = create_engine(DB_PATH, connect_args={"check_same_thread": False})
+# Reads go through a pool of query-only connections; every write goes through
+# `writer`, which owns the single connection of write_engine.
+engine = _make_engine(DB_POOL_SIZE, DB_MAX_OVERFLOW)
+write_engine = _make_engine(1, 0)
 SessionLocal = sessionmaker(bind=engine)
-Base.metadata.create_all(engine)
 
-def add_payment_transaction(order_id, amount, description, status):
+def _apply_pragmas(dbapi_conn):
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA cache_size={DB_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    cursor.close()
+
+@event.listens_for(engine, "connect")
+def _connect_reader(dbapi_conn, connection_record):
+    _apply_pragmas(dbapi_conn)
+    dbapi_conn.execute("PRAGMA query_only=ON")
+
+@event.listens_for(write_engine, "connect")
+def _connect_writer(dbapi_conn, connection_record):
+    _apply_pragmas(dbapi_conn)
+    # Let SQLAlchemy issue BEGIN itself (below) rather than the driver.
+    dbapi_conn.isolation_level = None
+
+@event.listens_for(write_engine, "begin")
+def _begin_immediate(conn):
+    # Take the write lock up front: a deferred transaction that reads first
+    # can fail with SQLITE_BUSY when it upgrades, without waiting.
+    conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    # One value, not a stack: a connection runs one statement at a time, and a
+    # failed statement (no after_cursor_execute) is simply overwritten.
+    conn.info["query_start"] = time.perf_counter()
+
+def _record_query_time(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info.pop("query_start")
+    metrics.db_queries.observe(elapsed, statement=metrics.statement_type(statement))
+
+for _engine in (engine, write_engine):
+    event.listen(_engine, "before_cursor_execute", _start_query_timer)
+    event.listen(_engine, "after_cursor_execute", _record_query_time)
+
+writer = SerialWriter(write_engine, batch_size=DB_WRITE_BATCH)
+
+# Bump when the models or triggers change; init_db() then migrates once.
+SCHEMA_VERSION = 3
+
+def _rebuild_rollups(conn, archived=()):
+    # archived: rollup rows (hour, currency, outcome, orders, amount dicts)
+    # for transactions no longer in the table, added on top of the table's.
+    table = RevenueRollup.__table__
+    conn.execute(table.delete())
+    conn.execute(text(
+        "INSERT INTO revenue_rollups (hour, currency, outcome, orders, amount) "
+        "SELECT strftime('%Y-%m-%d %H:00', created_at), "
+        f"{_rollup_currency_sql('currency')}, {_rollup_outcome_sql('status')}, COUNT(*), COALESCE(SUM(amount), 0) "
+        "FROM payment_transactions WHERE created_at IS NOT NULL GROUP BY 1, 2, 3"
+    ))
+    if archived:
+        upsert = sqlite_insert(table)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=["hour", "currency", "outcome"],
+            set_={
+                "orders": table.c.orders + upsert.excluded.orders,
+                "amount": table.c.amount + upsert.excluded.amount,
+            },
+        )
+        conn.execute(upsert, list(archived))
+    return conn.execute(select(func.count()).select_from(table)).scalar()
+
+def _add_rollup_currency(conn):
+    # Version 1 rollups had no currency; everything before was the default
+    # one. Copied over rather than rebuilt, which would lose archived rows.
+    conn.execute(text("ALTER TABLE revenue_rollups RENAME TO revenue_rollups_v1"))
+    RevenueRollup.__table__.create(conn)
+    conn.execute(text(
+        "INSERT INTO revenue_rollups (hour, currency, outcome, orders, amount) "
+        f"SELECT hour, '{DEFAULT_CURRENCY}', outcome, orders, amount FROM revenue_rollups_v1"
+    ))
+    conn.execute(text("DROP TABLE revenue_rollups_v1"))
+
+def init_db():
+    # Creates or migrates the schema. Called at startup (not import), and
+    # cheap once done: a single PRAGMA read. The migration itself runs in one
+    # BEGIN IMMEDIATE transaction, so when several workers start together one
+    # migrates and the others wait, re-check the version and skip.
+    # Returns True if this call migrated.
+    with engine.connect() as conn:
+        if conn.exec_driver_sql("PRAGMA user_version").scalar() >= SCHEMA_VERSION:
+            return False
+    with write_engine.begin() as conn:
+        if conn.exec_driver_sql("PRAGMA user_version").scalar() >= SCHEMA_VERSION:
+            return False
+        for name in _ROLLUP_TRIGGERS:
+            conn.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+        rollups_existed = inspect(conn).has_table(RevenueRollup.__tablename__)
+        if rollups_existed and "currency" not in {c["name"] for c in inspect(conn).get_columns(RevenueRollup.__tablename__)}:
+            _add_rollup_currency(conn)
+        Base.metadata.create_all(conn)
+        # create_all skips tables that already exist, so add columns and indexes introduced later.
+        existing_columns = {c["name"] for c in inspect(conn).get_columns(PaymentTransaction.__tablename__)}
+        for column in PaymentTransaction.__table__.columns:
+            if column.name not in existing_columns:
+                ddl = f"ALTER TABLE {PaymentTransaction.__tablename__} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+                if column.server_default is not None:
+                    # Also fills in the existing rows.
+                    ddl += f" DEFAULT '{column.server_default.arg}'"
+                conn.execute(text(ddl))
+        for index in PaymentTransaction.__table__.indexes:
+            index.create(conn, checkfirst=True)
+        for name, body in _ROLLUP_TRIGGERS.items():
+            conn.execute(text(f"CREATE TRIGGER {name} {body}"))
+        if not rollups_existed:
+            # First start with rollups: backfill the history already stored.
+            _rebuild_rollups(conn)
+        conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    return True
+
+def warm_pool():
+    # Opens the read pool's connections (and the writer's) up front, so the
+    # first requests do not pay for connecting and running the pragmas.
+    conns = [engine.connect() for _ in range(DB_POOL_SIZE)]
+    for conn in conns:
+        conn.close()
+    write_engine.connect().close()
+
+def rebuild_revenue_rollups(archived=()):
+    # Recomputes every rollup from payment_transactions plus `archived` (see
+    # _rebuild_rollups) in one transaction. Returns the number of rollup rows.
+    return writer.run(lambda conn: _rebuild_rollups(conn, archived))
+
+def get_revenue_rollups(since, granularity="day"):
+    # [(period, currency, {outcome: (orders, amount)})], newest first, for
+    # periods starting at or after `since` (a UTC datetime). Reads only the rollups.
+    width = 10 if granularity == "day" else 16
+    period = func.substr(RevenueRollup.hour, 1, width)
+    session = SessionLocal()
+    try:
+        rows = (
+            session.query(
+                period,
+                RevenueRollup.currency,
+                RevenueRollup.outcome,
+                func.sum(RevenueRollup.orders),
+                func.sum(RevenueRollup.amount),
+            )
+            .filter(RevenueRollup.hour >= since.strftime("%Y-%m-%d %H:00"))
+            .group_by(period, RevenueRollup.currency, RevenueRollup.outcome)
+            .order_by(period.desc(), RevenueRollup.currency)
+            .all()
+        )
+    finally:
+        session.close()
+    periods = {}
+    for key, currency, outcome, orders, amount in rows:
+        periods.setdefault((key, currency), {})[outcome] = (orders, amount)
+    return [(key, currency, outcomes) for (key, currency), outcomes in periods.items()]
+
+def add_payment_transactions(rows):
+    # rows: dicts with order_id, amount, currency, description, status,
+    # created_at, idempotency_key, redirect_uri and pos_id
+    if not rows:
+        return
+    # OR IGNORE: a row whose idempotency key is already stored records
+    # the same order, so it is dropped instead of failing the whole batch.
+    insert = PaymentTransaction.__table__.insert().prefix_with("OR IGNORE")
+    writer.run(lambda conn: conn.execute(insert, rows))
+
+def apply_order_statuses(updates, should_apply):
+    # updates: {order_id: new_status}. Rows are matched through the order_id
+    # index and only changed when should_apply(old_status, new_status) is true.
+    # Returns the set of order_ids that matched at least one row.
+    if not updates:
+        return set()
+    table = PaymentTransaction.__table__
+
+    def write(conn):
+        rows = conn.execute(
+            select(table.c.id, table.c.order_id, table.c.status).where(table.c.order_id.in_(list(updates)))
+        ).all()
+        changed = [
+            {"row_id": row.id, "new_status": updates[row.order_id]}
+            for row in rows
+            if should_apply(row.status, updates[row.order_id])
+        ]
+        if changed:
+            conn.execute(
+                table.update().where(table.c.id == bindparam("row_id")).values(status=bindparam("new_status")),
+                changed,
+            )
+        return {row.order_id for row in rows}
+
+    return writer.run(write)
+
+def get_payment_by_idempotency_key(key):
     session = SessionLocal()
-    tx = PaymentTransaction(order_id=order_id, amount=amount, description=description, status=status)
-    session.add(tx)
-    session.commit()
-    session.close()
+    try:
+        tx = session.query(PaymentTransaction).filter_by(idempotency_key=key).first()
+        return {"order_id": tx.order_id, "redirect_uri": tx.redirect_uri} if tx else None
+    finally:
+        session.close()
+
+def get_payments_by_idempotency_keys(keys):
+    # {key: {"order_id", "redirect_uri"}} for the keys already stored.
+    if not keys:
+        return {}
+    table = PaymentTransaction.__table__
+    query = select(table.c.idempotency_key, table.c.order_id, table.c.redirect_uri).where(
+        table.c.idempotency_key.in_(list(keys))
+    )
+    with engine.connect() as conn:
+        return {
+            row.idempotency_key: {"order_id": row.order_id, "redirect_uri": row.redirect_uri}
+            for row in conn.execute(query)
+        }
 
-def get_all_transactions():
+def get_pending_transactions(statuses, created_after, created_before, after=None, limit=500):
+    # Rows with a PayU order that may still change status, oldest first,
+    # keyset-paginated on (created_at, id) through the status index.
     session = SessionLocal()
-    txs = session.query(PaymentTransaction).order_by(PaymentTransaction.created_at.desc()).all()
-    session.close()
-    return txs
+    try:
+        q = session.query(
+            PaymentTransaction.id,
+            PaymentTransaction.order_id,
+            PaymentTransaction.status,
+            PaymentTransaction.created_at,
+            PaymentTransaction.pos_id,
+        ).filter(
+            PaymentTransaction.status.in_(list(statuses)),
+            PaymentTransaction.created_at >= created_after,
+            PaymentTransaction.created_at < created_before,
+            PaymentTransaction.order_id.isnot(None),
+        )
+        if after is not None:
+            after_created_at, after_id = after
+            q = q.filter(
+                PaymentTransaction.created_at >= after_created_at,
+                or_(
+                    PaymentTransaction.created_at > after_created_at,
+                    and_(PaymentTransaction.created_at == after_created_at, PaymentTransaction.id > after_id),
+                ),
+            )
+        return q.order_by(PaymentTransaction.created_at, PaymentTransaction.id).limit(limit).all()
+    finally:
+        session.close()
 
-def get_setting(key: str) -> str:
+def acquire_lease(name, owner, ttl):
+    # True if `owner` holds (or has just taken over) lease `name` for ttl seconds.
+    def write(conn):
+        now = time.time()
+        conn.execute(
+            text("INSERT OR IGNORE INTO leases (name, owner, expires_at) VALUES (:name, '', 0)"),
+            {"name": name},
+        )
+        result = conn.execute(
+            text("UPDATE leases SET owner = :owner, expires_at = :expires_at "
+                 "WHERE name = :name AND (owner = :owner OR expires_at < :now)"),
+            {"name": name, "owner": owner, "expires_at": now + ttl, "now": now},
+        )
+        return result.rowcount == 1
+    return writer.run(write)
+
+def get_archivable_transactions(created_before, limit=10000):
+    # Oldest rows created before `created_before`, all columns, oldest first.
+    table = PaymentTransaction.__table__
+    with engine.connect() as conn:
+        return conn.execute(
+            select(table)
+            .where(table.c.created_at < created_before)
+            .order_by(table.c.created_at, table.c.id)
+            .limit(limit)
+        ).all()
+
+def delete_transactions(ids, chunk_size=500):
+    # Used by archival; revenue_rollups deliberately keep the deleted rows.
+    ids = list(ids)
+    if not ids:
+        return
+    table = PaymentTransaction.__table__
+
+    def write(conn):
+        for start in range(0, len(ids), chunk_size):
+            conn.execute(table.delete().where(table.c.id.in_(ids[start:start + chunk_size])))
+
+    writer.run(write)
+
+EXPORT_COLUMNS = ("id", "order_id", "amount", "currency", "description", "status", "created_at")
+
+def iter_transactions(chunk_size=1000, **filters):
+    # Yields lists of row tuples (EXPORT_COLUMNS, oldest first) straight from
+    # one cursor, so memory stays flat however many rows match.
+    table = PaymentTransaction.__table__
+    query = (
+        select(*(table.c[name] for name in EXPORT_COLUMNS))
+        .where(*transaction_filters(**filters))
+        .order_by(table.c.created_at, table.c.id)
+    )
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+def transaction_filters(
+    status=None,
+    order_id=None,
+    min_amount=None,
+    max_amount=None,
+    created_from=None,
+    created_to=None,
+):
+    # WHERE clauses shared by the admin list and the export.
+    clauses = []
+    if status:
+        clauses.append(PaymentTransaction.status == status)
+    if order_id:
+        clauses.append(PaymentTransaction.order_id == order_id)
+    if min_amount is not None:
+        clauses.append(PaymentTransaction.amount >= min_amount)
+    if max_amount is not None:
+        clauses.append(PaymentTransaction.amount <= max_amount)
+    if created_from is not None:
+        clauses.append(PaymentTransaction.created_at >= created_from)
+    if created_to is not None:
+        clauses.append(PaymentTransaction.created_at < created_to)
+    return clauses
+
+def get_transactions_page(limit=50, after=None, **filters):
+    # Newest first, keyset-paginated on (created_at, id). `after` is the
+    # (created_at, id) of the last row of the previous page. Returns the page
+    # and the cursor for the next one (None on the last page).
     session = SessionLocal()
-    setting = session.query(Settings).filter_by(key=key).first()
-    session.close()
-    return setting.value if setting else ""
+    try:
+        q = session.query(PaymentTransaction).filter(*transaction_filters(**filters))
+        if after is not None:
+            after_created_at, after_id = after
+            q = q.filter(
+                PaymentTransaction.created_at <= after_created_at,
+                or_(
+                    PaymentTransaction.created_at < after_created_at,
+                    and_(PaymentTransaction.created_at == after_created_at, PaymentTransaction.id < after_id),
+                ),
+            )
+        txs = (
+            q.order_by(PaymentTransaction.created_at.desc(), PaymentTransaction.id.desc())
+            .limit(limit + 1)
+            .all()
+        )
+    finally:
+        session.close()
+    next_cursor = None
+    if len(txs) > limit:
+        txs = txs[:limit]
+        next_cursor = (txs[-1].created_at, txs[-1].id)
+    return txs, next_cursor
 
-def set_setting(key: str, value: str):
+# (settings dict, version file stamp, monotonic time of last version check)
+_settings_state = None
+
+def _settings_version():
+    try:
+        st = os.stat(SETTINGS_VERSION_FILE)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns
+
+def _bump_settings_version():
+    tmp = f"{SETTINGS_VERSION_FILE}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(os.urandom(8).hex())
+    # A fresh inode per write, so even same-tick writes change the stamp.
+    os.replace(tmp, SETTINGS_VERSION_FILE)
+
+def invalidate_settings_cache():
+    global _settings_state
+    _settings_state = None
+
+def get_all_settings() -> dict:
+    global _settings_state
+    now = time.monotonic()
+    state = _settings_state
+    if state is not None and now - state[2] < SETTINGS_CHECK_INTERVAL:
+        return state[0]
+    version = _settings_version()
+    if state is not None and state[1] == version:
+        _settings_state = (state[0], version, now)
+        return state[0]
+    # Version is read before the rows, so a concurrent write triggers a reload next time.
     session = SessionLocal()
-    setting = session.query(Settings).filter_by(key=key).first()
-    if setting:
-        setting.value = value
-    else:
-        setting = Settings(key=key, value=value)
-        session.add(setting)
-    session.commit()
-    session.close()
+    try:
+        settings = {s.key: s.value for s in session.query(Settings).all()}
+    finally:
+        session.close()
+    _settings_state = (settings, version, now)
+    return settings
+
+# (settings dict the set was loaded with, revoked session ids)
+_revoked_state = None
+
+def get_revoked_sessions():
+    # Reloaded only when the settings are (revoke_session bumps their
+    # version), so checking a session costs no I/O.
+    global _revoked_state
+    settings = get_all_settings()
+    state = _revoked_state
+    if state is None or state[0] is not settings:
+        with engine.connect() as conn:
+            ids = frozenset(conn.execute(
+                select(RevokedSession.session_id).where(RevokedSession.expires_at > time.time())
+            ).scalars())
+        state = _revoked_state = (settings, ids)
+    return state[1]
+
+def revoke_session(session_id, expires_at):
+    table = RevokedSession.__table__
+
+    def write(conn):
+        conn.execute(sqlite_insert(table).values(session_id=session_id, expires_at=expires_at).on_conflict_do_nothing())
+        conn.execute(table.delete().where(table.c.expires_at <= time.time()))
+    writer.run(write)
+    _bump_settings_version()
+    invalidate_settings_cache()
+
+def get_setting(key: str) -> str:
+    return get_all_settings().get(key) or ""
+
+def set_settings(values: dict):
+    upsert = sqlite_insert(Settings.__table__)
+    upsert = upsert.on_conflict_do_update(index_elements=["key"], set_={"value": upsert.excluded.value})
+    rows = [{"key": key, "value": value} for key, value in values.items()]
+    writer.run(lambda conn: conn.execute(upsert, rows))
+    _bump_settings_version()
+    invalidate_settings_cache()
+
+def ensure_setting(key: str, value: str) -> str:
+    # Stores `value` unless `key` already has one, and returns the stored
+    # value, so racing workers all end up with the same one.
+    def write(conn):
+        inserted = conn.execute(
+            sqlite_insert(Settings.__table__).values(key=key, value=value).on_conflict_do_nothing()
+        ).rowcount
+        stored = conn.execute(select(Settings.value).where(Settings.key == key)).scalar()
+        return stored, inserted
+    stored, inserted = writer.run(write)
+    if inserted:
+        _bump_settings_version()
+        invalidate_settings_cache()
+    return stored
+
+def set_setting(key: str, value: str):
+    set_settings({key: value})
@@ -0,0 +1,92 @@
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class SerialWriter:
+    # Runs every write for one SQLite database on a single thread, so writers
+    # in this process never contend for the file lock with each other. Jobs
+    # already waiting are committed together (group commit), each in its own
+    # savepoint so one failing job does not undo the others.
+    def __init__(self, engine, batch_size: int = 64):
+        self.engine = engine
+        self.batch_size = batch_size
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join(timeout)
+
+    def run(self, job: Callable[[Any], Any]) -> Any:
+        # job(conn) runs inside the writer's transaction; blocks until it has
+        # been committed and returns its result (or raises its exception).
+        if threading.current_thread() is self._thread:
+            with self.engine.begin() as conn:
+                return job(conn)
+        future: Future = Future()
+        self.start()
+        self._queue.put((job, future))
+        return future.result()
+
+    def _take_batch(self, first) -> Tuple[List[Tuple[Callable, Future]], bool]:
+        batch = [first]
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            batch, stopping = self._take_batch(item)
+            self._commit(batch)
+            if stopping:
+                return
+
+    def _commit(self, batch: List[Tuple[Callable, Future]]) -> None:
+        results = []
+        try:
+            with self.engine.begin() as conn:
+                for job, future in batch:
+                    try:
+                        with conn.begin_nested():
+                            results.append((future, job(conn), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+        except Exception as e:
+            logger.exception("Database write batch failed")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
@@ -0,0 +1,58 @@
+import csv
+import io
+import json
+import zlib
+from typing import Iterable, Iterator, Sequence
+
+from .db import EXPORT_COLUMNS
+
+FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+}
+
+
+def _value(v):
+    return v.isoformat() if hasattr(v, "isoformat") else v
+
+
+def _csv_chunk(rows: Sequence, header: bool = False) -> str:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if header:
+        writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        writer.writerow([_value(v) for v in row])
+    return buf.getvalue()
+
+
+def _ndjson_chunk(rows: Sequence) -> str:
+    return "".join(
+        json.dumps(dict(zip(EXPORT_COLUMNS, map(_value, row))), ensure_ascii=False) + "\n"
+        for row in rows
+    )
+
+
+def encode(chunks: Iterable[Sequence], fmt: str, compress: bool = False) -> Iterator[bytes]:
+    # Turns DB row chunks into CSV or NDJSON bytes, optionally gzip-streamed.
+    # Something is yielded before the first query result, so the client gets
+    # headers and a first byte right away.
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def out(text: str, flush: bool = False) -> bytes:
+        data = text.encode()
+        if gz is None:
+            return data
+        data = gz.compress(data)
+        return data + gz.flush(zlib.Z_SYNC_FLUSH) if flush else data
+
+    if fmt == "csv":
+        yield out(_csv_chunk((), header=True), flush=True)
+    elif gz is not None:
+        yield out("", flush=True)
+    for rows in chunks:
+        data = out(_csv_chunk(rows) if fmt == "csv" else _ndjson_chunk(rows))
+        if data:
+            yield data
+    if gz is not None:
+        yield gz.flush()
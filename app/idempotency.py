@@ -0,0 +1,70 @@
+import asyncio
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+# Client keys become PayU extOrderIds, so keep them short and URL-safe.
+KEY_PATTERN = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+
+def valid_key(key: str) -> bool:
+    return bool(KEY_PATTERN.match(key))
+
+
+class IdempotencyIndex:
+    # Expiring in-memory map of idempotency key -> future result. The first
+    # request for a key runs the call; concurrent and later duplicates await
+    # the same future instead of calling PayU again. Failed calls are
+    # forgotten so the client can retry. `lookup` checks the database for a
+    # key committed by another worker or before a restart.
+    def __init__(self, ttl: float = 86400.0, max_entries: int = 100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, asyncio.Future]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _get(self, key: str) -> Optional[asyncio.Future]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            return None
+        return entry[1]
+
+    def _put(self, key: str, future: asyncio.Future) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, future)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def run(
+        self,
+        key: str,
+        call: Callable[[], Awaitable[Any]],
+        lookup: Optional[Callable[[str], Any]] = None,
+    ) -> Tuple[Any, bool]:
+        # Returns (result, replayed).
+        future = self._get(key)
+        if future is not None:
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._put(key, future)
+        try:
+            stored = await asyncio.to_thread(lookup, key) if lookup else None
+            result = stored if stored is not None else await call()
+        except BaseException as e:
+            if self._entries.get(key, (None, None))[1] is future:
+                del self._entries[key]
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Mark retrieved; waiters (if any) still get the exception.
+                future.exception()
+            raise
+        future.set_result(result)
+        return result, stored is not None
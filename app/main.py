@@ -1,105 +1,268 @@
+import asyncio
+import datetime
+import json
+import logging
 import os
+import time
+from contextlib import asynccontextmanager
 from decimal import Decimal, InvalidOperation
+from typing import List, Optional
+from urllib.parse import urlencode
 
-from fastapi import FastAPI, Form, Request, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse, PlainTextResponse
-from .payu import PayUClient
+from fastapi import Depends, FastAPI, Form, Request, HTTPException
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+from .payu import AsyncPayUClient
+from .token_cache import SQLiteTokenStore, TokenCache
 
-from .db import get_setting, set_setting, add_payment_transaction, get_all_transactions
+from .db import (
+  ensure_setting,
+  get_all_settings,
+  init_db,
+  warm_pool,
+  add_payment_transactions,
+  get_payment_by_idempotency_key,
+  get_payments_by_idempotency_keys,
+  get_setting,
+  set_setting,
+  set_settings,
+  get_revenue_rollups,
+  get_revoked_sessions,
+  revoke_session,
+  writer as db_writer,
+)
+from . import export, metrics, templates
+from .archive import Archiver, SegmentStore, iter_all_transactions, search_transactions
+from .idempotency import IdempotencyIndex, valid_key as valid_idempotency_key
+from .notify import NotificationProcessor, verify_signature
+from .reconcile import Reconciler
+from .registry import DEFAULT_CURRENCY, PayURegistry, parse_extra_pos
+from .resilience import CircuitBreaker, CircuitOpenError, RateLimitedError, RetryPolicy, TokenBucket
+from .sessions import SessionSigner
+from .txlog import TransactionLogger
 from fastapi import Response, status
 from fastapi.responses import RedirectResponse
 from fastapi import Cookie
 import secrets
 
 def load_settings():
-  pos_id = get_setting("PAYU_POS_ID")
-  client_secret = get_setting("PAYU_CLIENT_SECRET")
-  app_base_url = get_setting("APP_BASE_URL") or "http://localhost:8000"
+  settings = get_all_settings()
+  pos_id = settings.get("PAYU_POS_ID") or ""
+  client_secret = settings.get("PAYU_CLIENT_SECRET") or ""
+  app_base_url = settings.get("APP_BASE_URL") or "http://localhost:8000"
   return pos_id, client_secret, app_base_url
 
-def save_settings(pos_id, client_secret, app_base_url):
-  set_setting("PAYU_POS_ID", pos_id)
-  set_setting("PAYU_CLIENT_SECRET", client_secret)
-  set_setting("APP_BASE_URL", app_base_url)
+def save_settings(pos_id, client_secret, app_base_url, second_key, extra_pos=""):
+  set_settings({
+    "PAYU_POS_ID": pos_id,
+    "PAYU_CLIENT_SECRET": client_secret,
+    "APP_BASE_URL": app_base_url,
+    "PAYU_SECOND_KEY": second_key,
+    "PAYU_POS_EXTRA": extra_pos,
+  })
+
+def notify_signature_key(body: bytes):
+  # Second key (MD5) of the POS the notification is for; the default POS
+  # when the body does not say.
+  try:
+    pos_id = json.loads(body)["order"]["merchantPosId"]
+  except (ValueError, KeyError, TypeError):
+    pos_id = None
+  return payu_clients_for_request().second_key(pos_id)
+
+# Shared by every client this worker builds and, through the store file, by
+# the other workers on this host.
+token_cache = TokenCache(
+  SQLiteTokenStore(os.getenv("PAYU_TOKEN_STORE", "payu_tokens.db")),
+  refresh_margin=float(os.getenv("PAYU_TOKEN_REFRESH_MARGIN", "60")),
+)
+
+def make_rate_limiter():
+  # Per POS and per worker process: divide the PayU quota by the worker count.
+  rate = float(os.getenv("PAYU_RATE_LIMIT", "20"))
+  if rate <= 0:
+    return None
+  return TokenBucket(
+    rate,
+    int(os.getenv("PAYU_RATE_BURST", str(max(1, int(rate))))),
+    max_waiters=int(os.getenv("PAYU_RATE_QUEUE", "100")),
+    max_wait=float(os.getenv("PAYU_RATE_MAX_WAIT", "2")),
+  )
+
+def make_payu_client(pos_id, client_secret, app_base_url):
+  return AsyncPayUClient(
+    pos_id,
+    client_secret,
+    app_base_url,
+    max_connections=int(os.getenv("PAYU_POOL_SIZE", "20")),
+    max_keepalive=int(os.getenv("PAYU_POOL_KEEPALIVE", "10")),
+    timeout=float(os.getenv("PAYU_TIMEOUT", "20")),
+    connect_timeout=float(os.getenv("PAYU_CONNECT_TIMEOUT", "5")),
+    token_cache=token_cache,
+    retry=RetryPolicy(
+      max_attempts=int(os.getenv("PAYU_RETRY_ATTEMPTS", "3")),
+      base_delay=float(os.getenv("PAYU_RETRY_BASE_DELAY", "0.2")),
+      max_delay=float(os.getenv("PAYU_RETRY_MAX_DELAY", "2")),
+    ),
+    breaker=CircuitBreaker(
+      failure_threshold=int(os.getenv("PAYU_BREAKER_THRESHOLD", "5")),
+      reset_timeout=float(os.getenv("PAYU_BREAKER_RESET", "30")),
+    ),
+    limiter=make_rate_limiter(),
+  )
+
+# One client per configured POS, kept in line with the settings (which other
+# workers may change) on every request that uses them.
+payu_clients = PayURegistry(make_payu_client)
+
+def payu_clients_for_request():
+  payu_clients.sync(get_all_settings())
+  return payu_clients
+
+txlog = TransactionLogger(
+  batch_size=int(os.getenv("TXLOG_BATCH_SIZE", "200")),
+  flush_interval=float(os.getenv("TXLOG_FLUSH_INTERVAL", "0.5")),
+  max_queue=int(os.getenv("TXLOG_MAX_QUEUE", "10000")),
+  durability=os.getenv("TXLOG_DURABILITY", "async"),
+)
+
+notifier = NotificationProcessor(
+  batch_size=int(os.getenv("NOTIFY_BATCH_SIZE", "500")),
+  flush_interval=float(os.getenv("NOTIFY_FLUSH_INTERVAL", "0.2")),
+  max_queue=int(os.getenv("NOTIFY_MAX_QUEUE", "50000")),
+)
+
+reconciler = Reconciler(
+  lambda pos_id: payu_clients_for_request().get(pos_id),
+  interval=float(os.getenv("RECONCILE_INTERVAL", "60")),
+  batch_size=int(os.getenv("RECONCILE_BATCH_SIZE", "500")),
+  concurrency=int(os.getenv("RECONCILE_CONCURRENCY", "4")),
+  rate=float(os.getenv("RECONCILE_RATE", "5")),
+  min_age=float(os.getenv("RECONCILE_MIN_AGE", "300")),
+  max_age=float(os.getenv("RECONCILE_MAX_AGE", str(7 * 86400))),
+)
+RECONCILE_ENABLED = os.getenv("RECONCILE_ENABLED", "1") == "1"
+
+# Cold storage for old transactions; searched and exported alongside the table.
+segments = SegmentStore()
+archiver = Archiver(segments, interval=float(os.getenv("ARCHIVE_INTERVAL", "86400")))
+# Opt-in: archival deletes rows from the database.
+ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "0") == "1"
+
+idempotency = IdempotencyIndex(ttl=float(os.getenv("IDEMPOTENCY_TTL", "86400")))
 
-POS_ID, CLIENT_SECRET, APP_BASE_URL = load_settings()
-payu = None
-if POS_ID and CLIENT_SECRET:
-  payu = PayUClient(POS_ID, CLIENT_SECRET, APP_BASE_URL)
 
 
 from fastapi.responses import Response
 from fastapi.exception_handlers import RequestValidationError
 from fastapi.exceptions import HTTPException as FastAPIHTTPException
 
-app = FastAPI(title="PayU Starter")
+# uvicorn's logger, so the startup report shows up with its default log config.
+logger = logging.getLogger("uvicorn.error")
+
+PAYU_WARMUP = os.getenv("PAYU_WARMUP", "1") == "1"
+PAYU_WARMUP_TIMEOUT = float(os.getenv("PAYU_WARMUP_TIMEOUT", "5"))
+
+async def startup():
+  # Runs before the worker accepts requests, so they find the schema in
+  # place, settings cached, DB connections open and PayU tokens ready.
+  timings = {}
+  started = time.perf_counter()
+
+  def phase(name, since):
+    timings[name] = time.perf_counter() - since
+    metrics.startup_seconds.set(timings[name], phase=name)
+    return time.perf_counter()
+
+  t = time.perf_counter()
+  migrated = await asyncio.to_thread(init_db)
+  t = phase("schema", t)
+  settings = await asyncio.to_thread(get_all_settings)
+  t = phase("settings", t)
+  payu_clients.sync(settings, warm_up=False)
+  t = phase("payu_clients", t)
+  await asyncio.to_thread(warm_pool)
+  t = phase("db_pool", t)
+  if PAYU_WARMUP:
+    await payu_clients.warm_up(PAYU_WARMUP_TIMEOUT)
+    t = phase("payu_warmup", t)
+  phase("total", started)
+  logger.info(
+    "Startup finished in %.3fs (%s%s)",
+    timings["total"],
+    ", ".join(f"{name} {seconds:.3f}s" for name, seconds in timings.items() if name != "total"),
+    ", schema migrated" if migrated else "",
+  )
+
+@asynccontextmanager
+async def lifespan(app):
+  await startup()
+  txlog.start()
+  notifier.start()
+  if RECONCILE_ENABLED:
+    reconciler.start()
+  if ARCHIVE_ENABLED:
+    archiver.start()
+  yield
+  await archiver.stop()
+  await reconciler.stop()
+  await txlog.stop()
+  await notifier.stop()
+  await payu_clients.aclose()
+  # Last: the queues above flush through it.
+  db_writer.stop()
+
+app = FastAPI(title="PayU Starter", lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
+
+metrics.queue_depth.set_function(txlog.pending, queue="txlog")
+metrics.queue_depth.set_function(notifier.pending, queue="notify")
+metrics.queue_depth.set_function(db_writer.pending, queue="db_writer")
+METRICS_ALLOWED_HOSTS = set(os.getenv("METRICS_ALLOWED_HOSTS", "127.0.0.1,::1").split(","))
+
+@app.get("/metrics")
+async def metrics_endpoint(request: Request):
+    # Per worker process; scrape each worker (or run one) for full totals.
+    if request.client and request.client.host not in METRICS_ALLOWED_HOSTS:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/static/app.css")
+async def app_stylesheet(request: Request):
+    return templates.stylesheet.response(request)
 
 # Custom error handler for HTTPException
 @app.exception_handler(FastAPIHTTPException)
 async def custom_http_exception_handler(request, exc):
+    if request.url.path.startswith("/api/"):
+        # Machine clients get FastAPI's default JSON body.
+        return JSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=getattr(exc, "headers", None))
     return HTMLResponse(
-        f"""
-        <html>
-          <head>
-            <title>Error</title>
-            <style>
-              body {{ font-family: 'Segoe UI', Arial, sans-serif; background: #f7f7f7; margin: 0; padding: 0; }}
-               .container {{ max-width: 900px; margin: 40px auto; background: #fff; border-radius: 8px; box-shadow: 0 2px 8px #0001; padding: 32px; }}
-              h2 {{ color: #c0392b; margin-bottom: 16px; }}
-              .msg {{ color: #34495e; font-size: 1.1em; margin-bottom: 24px; }}
-              a {{ color: #2980b9; text-decoration: none; font-size: 0.95em; }}
-              a:hover {{ text-decoration: underline; }}
-            </style>
-          </head>
-          <body>
-            <div class="container">
-              <h2>Error {exc.status_code}</h2>
-              <div class="msg">{exc.detail}</div>
-              <a href="/">← Back to Home</a>
-            </div>
-          </body>
-        </html>
-        """,
-        status_code=exc.status_code
+        templates.render_error(exc.status_code, exc.detail),
+        status_code=exc.status_code,
+        headers=getattr(exc, "headers", None),
     )
 
 # --- Admin login helpers ---
-ADMIN_SESSION_KEY = "admin_session"
 ADMIN_PASSWORD_KEY = "ADMIN_PASSWORD"
+# HMAC key for admin session cookies; generated once and shared by all workers.
+ADMIN_SESSION_SECRET_KEY = "ADMIN_SESSION_SECRET"
+ADMIN_SESSION_TTL = int(os.getenv("ADMIN_SESSION_TTL", "3600"))
+
+# Revocations are shared through the database and reloaded with the settings.
+admin_sessions = SessionSigner(
+  lambda: ensure_setting(ADMIN_SESSION_SECRET_KEY, secrets.token_urlsafe(32)),
+  get_revoked_sessions,
+  revoke_session,
+  ttl=ADMIN_SESSION_TTL,
+)
 
 def is_admin_logged_in(session: str = None):
-    admin_session = get_setting(ADMIN_SESSION_KEY)
-    return session and admin_session and secrets.compare_digest(session, admin_session)
+    return admin_sessions.verify(session)
 
 @app.get("/admin/login", response_class=HTMLResponse)
-async def admin_login_page():
-    return """
-    <html>
-      <head>
-        <title>Admin Login</title>
-        <style>
-          body { font-family: 'Segoe UI', Arial, sans-serif; background: #f7f7f7; }
-           .container { max-width: 900px; margin: 40px auto; background: #fff; border-radius: 8px; box-shadow: 0 2px 8px #0001; padding: 32px; }
-          h2 { color: #2c3e50; margin-bottom: 24px; }
-          label { display: block; margin-bottom: 12px; font-weight: 500; color: #34495e; }
-          input[type='password'] { width: 100%; padding: 8px; border: 1px solid #ccc; border-radius: 4px; margin-top: 4px; margin-bottom: 16px; font-size: 1em; }
-          button { background: #2980b9; color: #fff; border: none; padding: 10px 24px; border-radius: 4px; font-size: 1em; cursor: pointer; transition: background 0.2s; }
-          button:hover { background: #3498db; }
-        </style>
-      </head>
-      <body>
-        <div class="container">
-          <h2>Admin Login</h2>
-          <form method='post' action='/admin/login'>
-            <label>Password:
-              <input type='password' name='password' placeholder='Enter admin password'/>
-            </label>
-            <button type='submit'>Login</button>
-          </form>
-        </div>
-      </body>
-    </html>
-    """
+async def admin_login_page(request: Request):
+    return templates.admin_login_page.response(request)
 
 @app.post("/admin/login", response_class=HTMLResponse)
 async def admin_login(request: Request):
@@ -111,39 +274,16 @@ async def admin_login(request: Request):
         set_setting(ADMIN_PASSWORD_KEY, password)
         admin_password = password
     if secrets.compare_digest(password, admin_password):
-        session_token = secrets.token_urlsafe(32)
-        set_setting(ADMIN_SESSION_KEY, session_token)
         response = RedirectResponse(url="/admin", status_code=303)
-        response.set_cookie(key="admin_session", value=session_token, httponly=True, max_age=3600)
+        response.set_cookie(
+            key="admin_session", value=admin_sessions.issue(), httponly=True, samesite="lax", max_age=ADMIN_SESSION_TTL
+        )
         return response
-    return HTMLResponse(
-        """
-        <html>
-          <head>
-            <title>Admin Login - PayU Starter</title>
-            <style>
-              body { font-family: 'Segoe UI', Arial, sans-serif; background: #f7f7f7; margin: 0; padding: 0; }
-              .container { max-width: 900px; margin: 40px auto; background: #fff; border-radius: 8px; box-shadow: 0 2px 8px #0001; padding: 32px; }
-              h2 { color: #c0392b; margin-bottom: 24px; }
-              p { color: #34495e; font-size: 1.1em; margin-bottom: 24px; }
-              a { color: #2980b9; text-decoration: none; font-size: 1.1em; font-weight: 500; }
-              a:hover { text-decoration: underline; }
-            </style>
-          </head>
-          <body>
-            <div class="container">
-              <h2>Login failed</h2>
-              <p>Incorrect password.</p>
-              <a href='/admin/login'>Try again</a>
-            </div>
-          </body>
-        </html>
-        """,
-        status_code=401
-    )
+    return templates.login_failed_page.response(request)
 
 @app.get("/admin/logout", response_class=HTMLResponse)
-async def admin_logout():
+async def admin_logout(admin_session: str = Cookie(None)):
+    admin_sessions.revoke(admin_session)
     response = RedirectResponse(url="/admin/login", status_code=303)
     response.delete_cookie("admin_session")
     return response
@@ -153,52 +293,10 @@ async def admin_page(request: Request, admin_session: str = Cookie(None)):
     if not is_admin_logged_in(admin_session):
         return RedirectResponse(url="/admin/login", status_code=303)
     pos_id, client_secret, app_base_url = load_settings()
-    return f"""
-    <html>
-      <head>
-        <title>Admin Settings</title>
-        <style>
-          body {{ font-family: 'Segoe UI', Arial, sans-serif; background: #f7f7f7; margin: 0; padding: 0; }}
-           .container {{ max-width: 900px; margin: 40px auto; background: #fff; border-radius: 8px; box-shadow: 0 2px 8px #0001; padding: 32px; }}
-          h2 {{ color: #2c3e50; margin-bottom: 24px; }}
-          label {{ display: block; margin-bottom: 12px; font-weight: 500; color: #34495e; }}
-          input[type='text'] {{ width: 100%; padding: 8px; border: 1px solid #ccc; border-radius: 4px; margin-top: 4px; margin-bottom: 16px; font-size: 1em; }}
-          button {{ background: #2980b9; color: #fff; border: none; padding: 10px 24px; border-radius: 4px; font-size: 1em; cursor: pointer; transition: background 0.2s; }}
-          button:hover {{ background: #3498db; }}
-          .back {{ display: inline-block; margin-top: 24px; color: #2980b9; text-decoration: none; font-size: 0.95em; }}
-          .back:hover {{ text-decoration: underline; }}
-          .tab {{ display: inline-block; margin-right: 16px; color: #2980b9; text-decoration: none; font-size: 1em; font-weight: 500; }}
-          .tab:hover {{ text-decoration: underline; }}
-          .logout {{ float: right; color: #c0392b; text-decoration: none; font-size: 0.95em; font-weight: 500; margin-top: 8px; }}
-          .logout:hover {{ text-decoration: underline; }}
-        </style>
-      </head>
-      <body>
-        <div class="container">
-          <h2>PayU Settings (Admin)
-            <a class="logout" href="/admin/logout">Logout</a>
-          </h2>
-          <div style="margin-bottom: 24px;">
-            <a class="tab" href="/admin">Settings</a>
-            <a class="tab" href="/admin/transactions">Transactions</a>
-          </div>
-          <form method='post' action='/admin'>
-            <label>PAYU_POS_ID:
-              <input type='text' name='pos_id' value='{pos_id}' placeholder='Enter POS ID'/>
-            </label>
-            <label>PAYU_CLIENT_SECRET:
-              <input type='text' name='client_secret' value='{client_secret}' placeholder='Enter Client Secret'/>
-            </label>
-            <label>APP_BASE_URL:
-              <input type='text' name='app_base_url' value='{app_base_url}' placeholder='http://localhost:8000'/>
-            </label>
-            <button type='submit'>Save Settings</button>
-          </form>
-          <a class='back' href='/'>← Back to Home</a>
-        </div>
-      </body>
-    </html>
-    """
+    second_key = get_setting("PAYU_SECOND_KEY")
+    extra_pos = get_setting("PAYU_POS_EXTRA")
+    breakers = [(client.pos_id, client.breaker.snapshot()) for client in payu_clients_for_request().clients()]
+    return templates.render_admin_settings(pos_id, client_secret, second_key, app_base_url, extra_pos, breakers)
 
 @app.post("/admin", response_class=HTMLResponse)
 async def admin_save(request: Request, admin_session: str = Cookie(None)):
@@ -208,110 +306,28 @@ async def admin_save(request: Request, admin_session: str = Cookie(None)):
   pos_id = form.get("pos_id", "")
   client_secret = form.get("client_secret", "")
   app_base_url = form.get("app_base_url", "http://localhost:8000")
-  save_settings(pos_id, client_secret, app_base_url)
-  # Reload settings and PayUClient
-  global POS_ID, CLIENT_SECRET, APP_BASE_URL, payu
-  POS_ID, CLIENT_SECRET, APP_BASE_URL = load_settings()
-  payu = None
-  if POS_ID and CLIENT_SECRET:
-    payu = PayUClient(POS_ID, CLIENT_SECRET, APP_BASE_URL)
+  second_key = form.get("second_key", "")
+  extra_pos = form.get("extra_pos", "").strip()
+  try:
+    parse_extra_pos(extra_pos)
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=f"Invalid additional POS: {e}")
+  save_settings(pos_id, client_secret, app_base_url, second_key, extra_pos)
+  # Reconfigures changed clients in place; other workers follow on their next request.
+  payu_clients_for_request()
   return RedirectResponse(url="/admin", status_code=303)
 
 
 
 @app.get("/", response_class=HTMLResponse)
-async def home():
-    return """
-    <html>
-      <head>
-        <title>PayU Starter</title>
-        <style>
-          body { font-family: 'Segoe UI', Arial, sans-serif; background: #f7f7f7; margin: 0; padding: 0; }
-          .container { max-width: 900px; margin: 40px auto; background: #fff; border-radius: 8px; box-shadow: 0 2px 8px #0001; padding: 32px; }
-          h1 { color: #2c3e50; margin-bottom: 24px; }
-          p { color: #34495e; font-size: 1.1em; margin-bottom: 24px; }
-          .links { margin-top: 32px; }
-          a { display: inline-block; margin-right: 24px; color: #2980b9; text-decoration: none; font-size: 1.1em; font-weight: 500; }
-          a:hover { text-decoration: underline; }
-        </style>
-      </head>
-      <body>
-        <div class="container">
-          <h1>PayU Starter</h1>
-          <p>
-            Welcome to PayU Starter, a FastAPI MVP for integrating PayU payments.<br>
-            <b>Note:</b> You must first <a href='https://secure.snd.payu.com/'>register for a PayU account</a> and obtain sandbox credentials before using this app.<br>
-            Use the links below to create a payment or manage settings and review transactions in the admin panel.
-          </p>
-          <div class="links">
-            <a href="/pay">Create Payment</a>
-            <a href="/admin">Admin Panel</a>
-          </div>
-        </div>
-      </body>
-    </html>
-    """
+async def home(request: Request):
+    return templates.home_page.response(request)
 
 @app.get("/pay", response_class=HTMLResponse)
-async def pay_page():
-    if not POS_ID or not CLIENT_SECRET:
-        return """
-        <html>
-          <head>
-            <title>PayU Starter - Setup Required</title>
-            <style>
-              body { font-family: 'Segoe UI', Arial, sans-serif; background: #f7f7f7; margin: 0; padding: 0; }
-               .container { max-width: 900px; margin: 40px auto; background: #fff; border-radius: 8px; box-shadow: 0 2px 8px #0001; padding: 32px; }
-              h2 { color: #c0392b; margin-bottom: 24px; }
-              p { color: #34495e; font-size: 1.1em; }
-              a { color: #2980b9; text-decoration: none; }
-              a:hover { text-decoration: underline; }
-            </style>
-          </head>
-          <body>
-            <div class="container">
-              <h2>PayU Starter - Setup Required</h2>
-              <p>PayU credentials are not set.</p>
-              <p>Please go to <a href='/admin'>Admin Settings</a> to configure PAYU_POS_ID and PAYU_CLIENT_SECRET.</p>
-            </div>
-          </body>
-        </html>
-        """
-    return """
-    <html>
-      <head>
-        <title>PayU Starter - Create Payment</title>
-        <style>
-          body { font-family: 'Segoe UI', Arial, sans-serif; background: #f7f7f7; margin: 0; padding: 0; }
-          .container { max-width: 900px; margin: 40px auto; background: #fff; border-radius: 8px; box-shadow: 0 2px 8px #0001; padding: 32px; }
-          h2 { color: #2c3e50; margin-bottom: 24px; }
-          label { display: block; margin-bottom: 12px; font-weight: 500; color: #34495e; }
-          input[type='text'] { width: 100%; padding: 8px; border: 1px solid #ccc; border-radius: 4px; margin-top: 4px; margin-bottom: 16px; font-size: 1em; }
-          button { background: #27ae60; color: #fff; border: none; padding: 10px 24px; border-radius: 4px; font-size: 1em; cursor: pointer; transition: background 0.2s; }
-          button:hover { background: #2ecc71; }
-          .info { color: #7f8c8d; font-size: 0.95em; margin-top: 16px; }
-          .admin-link { display: inline-block; margin-top: 24px; color: #2980b9; text-decoration: none; font-size: 0.95em; }
-          .admin-link:hover { text-decoration: underline; }
-        </style>
-      </head>
-      <body>
-        <div class="container">
-          <h2>Create PayU Payment (Sandbox)</h2>
-          <form method="post" action="/pay">
-            <label>Amount (PLN):
-              <input type="text" name="amount_pln" value="12.34" placeholder="e.g. 12.34" />
-            </label>
-            <label>Description:
-              <input type="text" name="description" value="Test payment" size="40" placeholder="e.g. Test payment"/>
-            </label>
-            <button type="submit">Pay with PayU</button>
-          </form>
-          <div class="info">After payment, you will be redirected back to <b>/return</b>.</div>
-          <a class="admin-link" href="/admin">Admin Settings</a>
-        </div>
-      </body>
-    </html>
-    """
+async def pay_page(request: Request):
+    if not payu_clients_for_request():
+        return templates.setup_required_page.response(request)
+    return templates.pay_page.response(request)
 
 
 def pln_to_grosze(amount_pln_str: str) -> int:
@@ -322,93 +338,362 @@ def pln_to_grosze(amount_pln_str: str) -> int:
     raise HTTPException(status_code=400, detail="Invalid amount")
 
 
-@app.post("/pay")
-async def create_payment(amount_pln: str = Form(...), description: str = Form("Order")):
-  if not payu:
-    raise HTTPException(status_code=503, detail="PayU credentials not set. Please configure in /admin.")
-  total_amount_grosze = pln_to_grosze(amount_pln)
+async def place_order(payu, total_amount_grosze, description, currency, idempotency_key=None):
   try:
-    res = payu.create_order(
+    res = await payu.create_order(
       total_amount_grosze=total_amount_grosze,
       description=description or "Order",
       product_name=description or "Order",
+      currency=currency,
+      ext_order_id=idempotency_key,
     )
+  except RateLimitedError as e:
+    # Shed before reaching PayU: nothing to record.
+    raise HTTPException(status_code=503, detail=f"Too many payments right now: {e}", headers={"Retry-After": str(int(e.retry_after))})
+  except CircuitOpenError as e:
+    # Also never reached PayU; counted in payu_circuit_rejected_total instead.
+    raise HTTPException(status_code=503, detail=f"PayU unavailable: {e}", headers={"Retry-After": str(int(e.retry_after))})
   except Exception as e:
-    add_payment_transaction(order_id=None, amount=total_amount_grosze, description=description, status=f"ERROR: {e}")
+    await txlog.log(order_id=None, amount=total_amount_grosze, description=description, status=f"ERROR: {e}", pos_id=payu.pos_id, currency=currency)
     raise HTTPException(status_code=502, detail=f"PayU error: {e}")
 
   status = res.get("status", {}).get("statusCode")
   order_id = res.get("orderId")
   if status != "SUCCESS":
-    add_payment_transaction(order_id=order_id, amount=total_amount_grosze, description=description, status=f"PayU status: {status}")
+    await txlog.log(order_id=order_id, amount=total_amount_grosze, description=description, status=f"PayU status: {status}", pos_id=payu.pos_id, currency=currency)
     raise HTTPException(status_code=502, detail=f"PayU status: {status}")
 
   redirect_uri = res.get("redirectUri")
   if not redirect_uri:
-    add_payment_transaction(order_id=order_id, amount=total_amount_grosze, description=description, status="Missing redirectUri")
+    await txlog.log(order_id=order_id, amount=total_amount_grosze, description=description, status="Missing redirectUri", pos_id=payu.pos_id, currency=currency)
     raise HTTPException(status_code=502, detail="Missing redirectUri from PayU")
 
-  add_payment_transaction(order_id=order_id, amount=total_amount_grosze, description=description, status="SUCCESS")
-  response = RedirectResponse(url=redirect_uri, status_code=303)
-  response.set_cookie("payu_order_id", order_id or "", max_age=3600, httponly=True)
+  await txlog.log(
+    order_id=order_id,
+    amount=total_amount_grosze,
+    description=description,
+    status="SUCCESS",
+    idempotency_key=idempotency_key,
+    redirect_uri=redirect_uri,
+    pos_id=payu.pos_id,
+    currency=currency,
+  )
+  return {"order_id": order_id, "redirect_uri": redirect_uri}
+
+
+@app.post("/pay")
+async def create_payment(
+  request: Request,
+  amount_pln: str = Form(...),
+  description: str = Form("Order"),
+  idempotency_key: str = Form(""),
+  currency: str = Form(DEFAULT_CURRENCY),
+  merchant: str = Form(""),
+):
+  clients = payu_clients_for_request()
+  if not clients:
+    raise HTTPException(status_code=503, detail="PayU credentials not set. Please configure in /admin.")
+  currency = currency.upper()
+  try:
+    payu = clients.route(currency, merchant)
+  except LookupError as e:
+    raise HTTPException(status_code=400, detail=str(e))
+  total_amount_grosze = pln_to_grosze(amount_pln)
+  key = request.headers.get("Idempotency-Key") or idempotency_key
+  if key:
+    if not valid_idempotency_key(key):
+      raise HTTPException(status_code=400, detail="Invalid idempotency key")
+    # Double submits and proxy retries share the first call's order.
+    result, replayed = await idempotency.run(
+      key,
+      lambda: place_order(payu, total_amount_grosze, description, currency, key),
+      get_payment_by_idempotency_key,
+    )
+    if replayed:
+      metrics.idempotent_replays.inc()
+  else:
+    result = await place_order(payu, total_amount_grosze, description, currency)
+
+  response = RedirectResponse(url=result["redirect_uri"], status_code=303)
+  response.set_cookie("payu_order_id", result["order_id"] or "", max_age=3600, httponly=True)
   return response
+
+
+# --- Batch order API (back-office jobs) ---
+# Bearer token for the API; signed-in admins can use it with their cookie.
+API_TOKEN = os.getenv("API_TOKEN", "")
+BATCH_MAX_ORDERS = int(os.getenv("BATCH_MAX_ORDERS", "100"))
+# Per POS: orders of one batch in flight at once (the rate limit still applies).
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "5"))
+
+class BatchProduct(BaseModel):
+  name: str
+  unitPrice: int
+  quantity: int = 1
+
+class BatchOrder(BaseModel):
+  # PayU's own order fields (amounts in minor units) minus those the app
+  # fills in; extOrderId doubles as the idempotency key.
+  description: str = "Order"
+  currencyCode: str = DEFAULT_CURRENCY
+  merchant: str = ""
+  totalAmount: Optional[int] = None
+  products: List[BatchProduct] = []
+  extOrderId: str = ""
+  customerIp: str = "127.0.0.1"
+
+class OrderBatch(BaseModel):
+  orders: List[BatchOrder]
+
+def require_api_auth(request: Request, admin_session: str = Cookie(None)):
+  auth = request.headers.get("Authorization", "")
+  if API_TOKEN and auth.startswith("Bearer ") and secrets.compare_digest(auth[len("Bearer "):], API_TOKEN):
+    return
+  if not is_admin_logged_in(admin_session):
+    raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+
+def batch_order_arguments(order: BatchOrder):
+  # create_order keyword arguments for one batch item; raises ValueError.
+  products = [{"name": p.name, "unitPrice": p.unitPrice, "quantity": p.quantity} for p in order.products]
+  if any(p["unitPrice"] < 0 or p["quantity"] < 1 for p in products):
+    raise ValueError("Invalid product price or quantity")
+  total = order.totalAmount
+  if products:
+    products_total = sum(p["unitPrice"] * p["quantity"] for p in products)
+    if total is None:
+      total = products_total
+    elif total != products_total:
+      raise ValueError("totalAmount does not match the products")
+  if total is None or total <= 0:
+    raise ValueError("Invalid amount")
+  if order.extOrderId and not valid_idempotency_key(order.extOrderId):
+    raise ValueError("Invalid idempotency key")
+  return {
+    "total_amount_grosze": total,
+    "description": order.description or "Order",
+    "product_name": order.description or "Order",
+    "currency": order.currencyCode.upper(),
+    "customer_ip": order.customerIp,
+    "ext_order_id": order.extOrderId or None,
+    "products": products or None,
+  }
+
+def batch_result(order_id=None, redirect_uri=None, error=None):
+  return {"orderId": order_id, "redirectUri": redirect_uri, "error": error}
+
+def batch_outcome(res):
+  # (result, status to record) for one create_order outcome, as place_order
+  # reports it; the status is None when the order never reached PayU.
+  if isinstance(res, RateLimitedError):
+    return batch_result(error=f"Too many payments right now: {res}"), None
+  if isinstance(res, CircuitOpenError):
+    return batch_result(error=f"PayU unavailable: {res}"), None
+  if isinstance(res, BaseException):
+    return batch_result(error=f"PayU error: {res}"), f"ERROR: {res}"
+  status = res.get("status", {}).get("statusCode")
+  order_id = res.get("orderId")
+  if status != "SUCCESS":
+    return batch_result(order_id, error=f"PayU status: {status}"), f"PayU status: {status}"
+  redirect_uri = res.get("redirectUri")
+  if not redirect_uri:
+    return batch_result(order_id, error="Missing redirectUri from PayU"), "Missing redirectUri"
+  return batch_result(order_id, redirect_uri), "SUCCESS"
+
+async def place_orders(clients, orders: List[BatchOrder]):
+  # One result per order, in request order. Orders go out concurrently (per
+  # POS, up to BATCH_CONCURRENCY each); every order sent to PayU is recorded
+  # in one insert before this returns.
+  results = [None] * len(orders)
+  stored = await asyncio.to_thread(get_payments_by_idempotency_keys, {o.extOrderId for o in orders if o.extOrderId})
+  seen = set()
+  by_pos = {}
+  for i, order in enumerate(orders):
+    key = order.extOrderId
+    if key and key in stored:
+      metrics.idempotent_replays.inc()
+      results[i] = batch_result(stored[key]["order_id"], stored[key]["redirect_uri"])
+      continue
+    if key and key in seen:
+      results[i] = batch_result(error="Duplicate extOrderId in batch")
+      continue
+    seen.add(key)
+    try:
+      payu = clients.route(order.currencyCode, order.merchant)
+      arguments = batch_order_arguments(order)
+    except (LookupError, ValueError) as e:
+      results[i] = batch_result(error=str(e))
+      continue
+    by_pos.setdefault(payu.pos_id, (payu, []))[1].append((i, arguments))
+
+  async def create(payu, items):
+    return payu, items, await payu.create_orders([arguments for _, arguments in items], concurrency=BATCH_CONCURRENCY)
+
+  rows = []
+  created_at = datetime.datetime.utcnow()
+  for payu, items, responses in await asyncio.gather(*(create(payu, items) for payu, items in by_pos.values())):
+    for (i, arguments), res in zip(items, responses):
+      results[i], status = batch_outcome(res)
+      if status is None:
+        continue
+      success = status == "SUCCESS"
+      rows.append({
+        "order_id": results[i]["orderId"],
+        "amount": arguments["total_amount_grosze"],
+        "currency": arguments["currency"],
+        "description": orders[i].description,
+        "status": status,
+        "created_at": created_at,
+        "idempotency_key": arguments["ext_order_id"] if success else None,
+        "redirect_uri": results[i]["redirectUri"] if success else None,
+        "pos_id": payu.pos_id,
+      })
+  try:
+    await asyncio.to_thread(add_payment_transactions, rows)
+  except Exception:
+    # The orders exist at PayU either way; the caller still needs their results.
+    logger.exception(
+      "Failed to record %d batch orders: %s", len(rows), ", ".join(str(row["order_id"]) for row in rows)
+    )
+  return results
+
+@app.post("/api/orders/batch", dependencies=[Depends(require_api_auth)])
+async def create_orders_batch(batch: OrderBatch):
+  if len(batch.orders) > BATCH_MAX_ORDERS:
+    raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ORDERS} orders per batch")
+  clients = payu_clients_for_request()
+  if not clients:
+    raise HTTPException(status_code=503, detail="PayU credentials not set. Please configure in /admin.")
+  return {"results": await place_orders(clients, batch.orders)}
 # --- Admin login helpers ---
+TRANSACTIONS_PAGE_SIZE = 50
+
+def parse_date(value: str) -> datetime.datetime:
+  try:
+    return datetime.datetime.combine(datetime.date.fromisoformat(value), datetime.time())
+  except ValueError:
+    raise HTTPException(status_code=400, detail="Invalid date")
+
+def parse_cursor(value: str):
+  try:
+    created_at, tx_id = value.rsplit("_", 1)
+    return datetime.datetime.fromisoformat(created_at), int(tx_id)
+  except ValueError:
+    raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def format_cursor(cursor) -> str:
+  created_at, tx_id = cursor
+  return f"{created_at.isoformat()}_{tx_id}"
+
+def parse_transaction_filters(status, order_id, min_amount, max_amount, date_from, date_to):
+  # Raw query values (as echoed back into the filter form) and the matching db filters.
+  form = {
+    "status": status,
+    "order_id": order_id,
+    "min_amount": min_amount,
+    "max_amount": max_amount,
+    "date_from": date_from,
+    "date_to": date_to,
+  }
+  query = dict(
+    status=status or None,
+    order_id=order_id or None,
+    min_amount=pln_to_grosze(min_amount) if min_amount else None,
+    max_amount=pln_to_grosze(max_amount) if max_amount else None,
+    created_from=parse_date(date_from) if date_from else None,
+    # date_to is inclusive
+    created_to=parse_date(date_to) + datetime.timedelta(days=1) if date_to else None,
+  )
+  return form, query
+
 @app.get("/admin/transactions", response_class=HTMLResponse)
-async def admin_transactions(admin_session: str = Cookie(None)):
+async def admin_transactions(
+    admin_session: str = Cookie(None),
+    status: str = "",
+    order_id: str = "",
+    min_amount: str = "",
+    max_amount: str = "",
+    date_from: str = "",
+    date_to: str = "",
+    after: str = "",
+):
+    if not is_admin_logged_in(admin_session):
+        return RedirectResponse(url="/admin/login", status_code=303)
+    filters, query = parse_transaction_filters(status, order_id, min_amount, max_amount, date_from, date_to)
+    # Off the event loop: archived segments are decompressed and parsed whole.
+    txs, next_cursor = await asyncio.to_thread(
+        search_transactions,
+        segments,
+        limit=TRANSACTIONS_PAGE_SIZE,
+        after=parse_cursor(after) if after else None,
+        **query,
+    )
+    active_filters = {k: v for k, v in filters.items() if v}
+    first_link = f"/admin/transactions?{urlencode(active_filters)}"
+    next_link = ""
+    if next_cursor:
+        next_link = f"/admin/transactions?{urlencode({**active_filters, 'after': format_cursor(next_cursor)})}"
+    return templates.render_transactions(txs, filters, first_link, next_link)
+
+DASHBOARD_MAX_DAYS = 366
+
+@app.get("/admin/dashboard", response_class=HTMLResponse)
+async def admin_dashboard(admin_session: str = Cookie(None), days: int = 7, granularity: str = "day"):
     if not is_admin_logged_in(admin_session):
         return RedirectResponse(url="/admin/login", status_code=303)
-    txs = get_all_transactions()
-    rows = "".join([
-        f"<tr><td>{tx.id}</td><td>{tx.order_id or ''}</td><td>{tx.amount/100:.2f} PLN</td><td>{tx.description}</td><td>{tx.status}</td><td>{tx.created_at.strftime('%Y-%m-%d %H:%M:%S')}</td></tr>"
-        for tx in txs
-    ])
-    return f"""
-    <html>
-      <head>
-        <title>Payment Transactions</title>
-        <style>
-          body {{ font-family: 'Segoe UI', Arial, sans-serif; background: #f7f7f7; }}
-          .container {{ max-width: 900px; margin: 40px auto; background: #fff; border-radius: 8px; box-shadow: 0 2px 8px #0001; padding: 32px; }}
-          h2 {{ color: #2c3e50; margin-bottom: 24px; }}
-          table {{ width: 100%; border-collapse: collapse; margin-top: 16px; }}
-          th, td {{ border: 1px solid #ccc; padding: 8px; text-align: left; }}
-          th {{ background: #2980b9; color: #fff; }}
-          tr:nth-child(even) {{ background: #f2f2f2; }}
-          .back {{ display: inline-block; margin-top: 24px; color: #2980b9; text-decoration: none; font-size: 0.95em; }}
-          .back:hover {{ text-decoration: underline; }}
-        </style>
-      </head>
-      <body>
-        <div class="container">
-          <h2>Payment Transactions</h2>
-          <table>
-            <tr><th>ID</th><th>Order ID</th><th>Amount</th><th>Description</th><th>Status</th><th>Created At</th></tr>
-            {rows}
-          </table>
-          <a class='back' href='/admin'>← Back to Admin</a>
-        </div>
-      </body>
-    </html>
-    """
+    if granularity not in ("day", "hour"):
+        raise HTTPException(status_code=400, detail="Invalid granularity")
+    days = min(max(days, 1), DASHBOARD_MAX_DAYS)
+    today = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    since = today - datetime.timedelta(days=days - 1)
+    periods = get_revenue_rollups(since, granularity)
+    return templates.render_dashboard(periods, days, granularity)
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+
+@app.get("/admin/transactions/export")
+async def admin_transactions_export(
+    admin_session: str = Cookie(None),
+    format: str = "csv",
+    gzip: bool = False,
+    status: str = "",
+    order_id: str = "",
+    min_amount: str = "",
+    max_amount: str = "",
+    date_from: str = "",
+    date_to: str = "",
+):
+    if not is_admin_logged_in(admin_session):
+        return RedirectResponse(url="/admin/login", status_code=303)
+    if format not in export.FORMATS:
+        raise HTTPException(status_code=400, detail="Invalid export format")
+    _, query = parse_transaction_filters(status, order_id, min_amount, max_amount, date_from, date_to)
+    media_type, extension = export.FORMATS[format]
+    filename = f"transactions-{datetime.datetime.utcnow():%Y%m%dT%H%M%SZ}.{extension}"
+    if gzip:
+        media_type = "application/gzip"
+        filename += ".gz"
+    # A sync generator: Starlette pulls it from a worker thread, chunk by chunk.
+    body = export.encode(iter_all_transactions(segments, chunk_size=EXPORT_CHUNK_SIZE, **query), format, compress=gzip)
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "Cache-Control": "no-store"},
+    )
 
 
 @app.post("/payu/notify")
 async def payu_notify(request: Request):
     body = await request.body()
     signature = request.headers.get("OpenPayU-Signature", "")
+    if not verify_signature(body, signature, notify_signature_key(body)):
+        return PlainTextResponse("Invalid signature", status_code=400)
+    if not notifier.submit(body):
+        # Queue full: a non-200 makes PayU retry later.
+        return PlainTextResponse("Busy", status_code=503)
     return PlainTextResponse("OK")
 
 
 @app.get("/return", response_class=HTMLResponse)
 async def return_page(request: Request):
     order_id = request.cookies.get("payu_order_id", "")
-    return f"""
-    <html>
-      <body style=\"font-family: sans-serif;\">
-        <h2>Payment flow finished (sandbox)</h2>
-        <p>Order ID (if known): {order_id}</p>
-        <p>Check your PayU sandbox panel for final status.</p>
-        <p><a href=\"/\">Back</a></p>
-      </body>
-    </html>
-    """
+    return templates.render_return(order_id)
@@ -0,0 +1,39 @@
+import argparse
+
+import datetime
+
+from . import archive, db
+
+
+def rebuild_rollups(args) -> None:
+    store = archive.SegmentStore()
+    # Rows both archived and still in the table would be counted twice.
+    archive.finish_interrupted_archival(store)
+    rows = db.rebuild_revenue_rollups(archive.archived_rollups(store))
+    print(f"Rebuilt revenue rollups: {rows} rows")
+
+
+def archive_transactions(args) -> None:
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=args.days)
+    moved = archive.archive_transactions(archive.SegmentStore(), cutoff)
+    print(f"Archived {moved} transactions created before {cutoff.isoformat()} into {archive.ARCHIVE_DIR}")
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.manage", description="PayU Starter maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser(
+        "rebuild-rollups", help="recompute the dashboard rollups from payment_transactions and the archive"
+    ).set_defaults(func=rebuild_rollups)
+    archive_parser = commands.add_parser("archive", help="move old transactions into compressed segment files")
+    archive_parser.add_argument(
+        "--days", type=float, default=archive.ARCHIVE_AFTER_DAYS, help="archive rows older than this many days"
+    )
+    archive_parser.set_defaults(func=archive_transactions)
+    args = parser.parse_args(argv)
+    db.init_db()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+import bisect
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Minimal Prometheus text-format metrics. Each worker process keeps its own
+# registry; updates take one uncontended lock and no I/O, so instrumentation
+# stays on in production.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+        self._functions: Dict[LabelValues, Callable[[], float]] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def set_function(self, fn: Callable[[], float], **labels) -> None:
+        # Sampled at scrape time, e.g. for queue depths.
+        self._functions[self._key(labels)] = fn
+
+    def remove(self, **labels) -> None:
+        key = self._key(labels)
+        self._values.pop(key, None)
+        self._functions.pop(key, None)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        values = dict(self._values)
+        for key, fn in self._functions.items():
+            values[key] = fn()
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            data[index] += 1
+            data[-1] += value
+
+    def time(self, **labels) -> "_Timer":
+        return _Timer(self, labels)
+
+    def count(self, **labels) -> int:
+        data = self._values.get(self._key(labels))
+        return sum(data[:-1]) if data else 0
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, data in sorted(self._values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), data[:-1]):
+                cumulative += n
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(data[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()) -> Gauge:
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.histogram(
+    "http_request_duration_seconds", "Request latency by route.", ("method", "route", "status"))
+http_in_flight = registry.gauge(
+    "http_requests_in_flight", "Requests currently being handled.")
+payu_requests = registry.histogram(
+    "payu_request_duration_seconds", "PayU API call latency.", ("call",))
+payu_responses = registry.counter(
+    "payu_responses_total", "PayU API responses by status code (0 = transport error).", ("call", "status_code"))
+payu_retries = registry.counter(
+    "payu_retries_total", "PayU API calls retried, by reason.", ("call", "reason"))
+payu_circuit_state = registry.gauge(
+    "payu_circuit_state", "PayU circuit breaker state: 0 closed, 1 half-open, 2 open.", ("pos_id",))
+payu_circuit_rejected = registry.counter(
+    "payu_circuit_rejected_total", "PayU API calls failed fast by an open circuit breaker.", ("pos_id", "call"))
+payu_admission_wait = registry.histogram(
+    "payu_admission_wait_seconds", "Time create_order calls waited for the per-POS rate limiter.", ("pos_id",))
+payu_admission_queue = registry.gauge(
+    "payu_admission_queue_depth", "create_order calls waiting for the per-POS rate limiter.", ("pos_id",))
+payu_rate_limited = registry.counter(
+    "payu_rate_limited_total", "create_order calls rejected by the per-POS rate limiter.", ("pos_id",))
+idempotent_replays = registry.counter(
+    "pay_idempotent_replays_total", "POST /pay duplicates answered without calling PayU.")
+reconciled_orders = registry.counter(
+    "reconciled_orders_total", "Pending orders checked against PayU, and how many changed.", ("result",))
+token_cache = registry.counter(
+    "payu_token_cache_total", "OAuth token lookups: hit, shared (from another worker) or miss.", ("result",))
+db_queries = registry.histogram(
+    "db_query_duration_seconds", "Database statement latency by statement type.", ("statement",))
+startup_seconds = registry.gauge(
+    "app_startup_duration_seconds", "Time spent in each startup phase of this worker.", ("phase",))
+queue_depth = registry.gauge(
+    "background_queue_depth", "Items waiting in background queues.", ("queue",))
+
+
+class MetricsMiddleware:
+    # Pure ASGI middleware: times every HTTP request and labels it with the
+    # matched route template, so /admin/transactions?... is a single series.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        http_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_in_flight.dec()
+            route = scope.get("route")
+            http_requests.observe(
+                time.perf_counter() - start,
+                method=scope["method"],
+                route=getattr(route, "path", "unmatched"),
+                status=status["code"],
+            )
+
+
+def statement_type(statement: Optional[str]) -> str:
+    words = (statement or "").split(None, 1)
+    word = words[0].upper() if words else ""
+    return word if word in ("SELECT", "INSERT", "UPDATE", "DELETE") else "other"
@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from .batching import STOP, collect_batch
+from .db import apply_order_statuses
+
+logger = logging.getLogger(__name__)
+
+# Later PayU order states win; COMPLETED and CANCELED are final. Statuses this
+# app writes itself ("SUCCESS" for a created order, errors) rank lowest.
+ORDER_STATUS_RANK = {
+    "NEW": 1,
+    "PENDING": 2,
+    "WAITING_FOR_CONFIRMATION": 3,
+    "COMPLETED": 4,
+    "CANCELED": 4,
+}
+TERMINAL_STATUSES = {"COMPLETED", "CANCELED"}
+
+_SIGNATURE_ALGORITHMS = {
+    "MD5": hashlib.md5,
+    "SHA": hashlib.sha1,
+    "SHA1": hashlib.sha1,
+    "SHA-1": hashlib.sha1,
+    "SHA256": hashlib.sha256,
+    "SHA-256": hashlib.sha256,
+    "SHA384": hashlib.sha384,
+    "SHA-384": hashlib.sha384,
+    "SHA512": hashlib.sha512,
+    "SHA-512": hashlib.sha512,
+}
+
+
+def verify_signature(body: bytes, header: str, second_key: str) -> bool:
+    # OpenPayU-Signature: sender=checkout;signature=<hex>;algorithm=MD5;content=DOCUMENT
+    parts = dict(p.split("=", 1) for p in header.split(";") if "=" in p)
+    signature = parts.get("signature", "")
+    digest = _SIGNATURE_ALGORITHMS.get(parts.get("algorithm", "MD5").upper())
+    if not signature or digest is None or not second_key:
+        return False
+    expected = digest(body + second_key.encode()).hexdigest()
+    return hmac.compare_digest(expected, signature.lower())
+
+
+def should_apply(old_status: Optional[str], new_status: str) -> bool:
+    if old_status in TERMINAL_STATUSES:
+        return False
+    return ORDER_STATUS_RANK.get(new_status, 0) > ORDER_STATUS_RANK.get(old_status, 0)
+
+
+def parse_notification(body: bytes) -> Optional[Tuple[str, str]]:
+    try:
+        order = json.loads(body)["order"]
+        return order["orderId"], order["status"]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+class NotificationProcessor:
+    # The webhook only verifies and enqueues; one background task applies the
+    # status changes in batches. Notifications already seen (PayU retries
+    # aggressively) and ones older than what is stored are dropped before
+    # reaching the database. Orders not found yet, e.g. still waiting in the
+    # write-behind transaction log, are retried for unmatched_ttl seconds.
+    def __init__(
+        self,
+        *,
+        batch_size: int = 500,
+        flush_interval: float = 0.2,
+        max_queue: int = 50000,
+        seen_capacity: int = 100000,
+        unmatched_ttl: float = 60.0,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.seen_capacity = seen_capacity
+        self.unmatched_ttl = unmatched_ttl
+        # Latest status accepted per order, bounded LRU.
+        self._latest: "OrderedDict[str, str]" = OrderedDict()
+        self._unmatched: Dict[str, Tuple[str, float]] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        await self._queue.put(STOP)
+        await self._task
+        self._task = None
+        self._queue = None
+
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def submit(self, body: bytes) -> bool:
+        # False when the queue is full; the caller should make PayU retry.
+        if self._queue is None:
+            return False
+        try:
+            self._queue.put_nowait(body)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    def _accept(self, order_id: str, status: str) -> bool:
+        # Drops duplicates and anything not newer than what was already accepted.
+        latest = self._latest.get(order_id)
+        if order_id in self._latest:
+            self._latest.move_to_end(order_id)
+            if not should_apply(latest, status):
+                return False
+        self._latest[order_id] = status
+        if len(self._latest) > self.seen_capacity:
+            self._latest.popitem(last=False)
+        return True
+
+    async def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            # Wake up periodically while there are unmatched updates to retry.
+            idle_timeout = 1.0 if self._unmatched else None
+            batch, stopping = await collect_batch(self._queue, self.batch_size, self.flush_interval, idle_timeout)
+            if batch or self._unmatched:
+                await self._flush(batch)
+
+    async def _flush(self, batch) -> None:
+        now = time.monotonic()
+        updates: Dict[str, str] = {}
+        first_seen: Dict[str, float] = {}
+        for order_id, (status, seen_at) in self._unmatched.items():
+            if now - seen_at < self.unmatched_ttl:
+                updates[order_id] = status
+                first_seen[order_id] = seen_at
+        self._unmatched.clear()
+        for body in batch:
+            parsed = parse_notification(body)
+            if parsed is None or not self._accept(*parsed):
+                continue
+            order_id, status = parsed
+            updates[order_id] = status
+            first_seen.setdefault(order_id, now)
+        if not updates:
+            return
+        try:
+            matched = await asyncio.to_thread(apply_order_statuses, updates, should_apply)
+        except Exception:
+            logger.exception("Failed to apply %d order status updates", len(updates))
+            matched = set()
+        for order_id, status in updates.items():
+            if order_id not in matched:
+                self._unmatched[order_id] = (status, first_seen[order_id])
@@ -1,18 +1,88 @@
+import asyncio
 import base64
+import hashlib
+import os
 import time
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
 
+import httpx
 import requests
 
-PAYU_OAUTH_URL = "https://secure.snd.payu.com/pl/standard/user/oauth/authorize"
-PAYU_ORDERS_URL = "https://secure.snd.payu.com/api/v2_1/orders"
+from . import metrics
+from .resilience import (
+    REJECTED_STATUSES,
+    TRANSIENT_STATUSES,
+    UNSENT_ERRORS,
+    CircuitBreaker,
+    CircuitOpenError,
+    RateLimitedError,
+    RetryPolicy,
+    TokenBucket,
+)
+from .token_cache import TokenCache
+
+# Point PAYU_BASE_URL at https://secure.payu.com for production, or at a local stub.
+PAYU_BASE_URL = os.getenv("PAYU_BASE_URL", "https://secure.snd.payu.com").rstrip("/")
+OAUTH_PATH = "/pl/standard/user/oauth/authorize"
+ORDERS_PATH = "/api/v2_1/orders"
+PAYU_OAUTH_URL = PAYU_BASE_URL + OAUTH_PATH
+PAYU_ORDERS_URL = PAYU_BASE_URL + ORDERS_PATH
+
+
+def _basic_auth(pos_id: str, client_secret: str) -> str:
+    return base64.b64encode(f"{pos_id}:{client_secret}".encode()).decode()
+
+
+def _order_payload(
+    *,
+    pos_id: str,
+    app_base_url: str,
+    total_amount_grosze: int,
+    description: str,
+    customer_ip: str,
+    product_name: str,
+    currency: str,
+    ext_order_id: Optional[str] = None,
+    products: Optional[List[Dict[str, Any]]] = None,
+) -> Dict[str, Any]:
+    # products: {"name", "unitPrice" (minor units), "quantity"} dicts; their
+    # total must equal total_amount_grosze. Defaults to one product_name item.
+    if products:
+        products = [
+            {"name": p["name"], "unitPrice": str(int(p["unitPrice"])), "quantity": str(int(p.get("quantity", 1)))}
+            for p in products
+        ]
+    else:
+        products = [
+            {
+                "name": product_name,
+                "unitPrice": str(total_amount_grosze),
+                "quantity": "1",
+            }
+        ]
+    payload = {
+        "notifyUrl": f"{app_base_url}/payu/notify",
+        "continueUrl": f"{app_base_url}/return",
+        "customerIp": customer_ip,
+        "merchantPosId": pos_id,
+        "description": description,
+        "currencyCode": currency,
+        "totalAmount": str(total_amount_grosze),
+        "products": products,
+    }
+    if ext_order_id:
+        # PayU rejects a second order with the same extOrderId on a POS.
+        payload["extOrderId"] = ext_order_id
+    return payload
 
 
 class PayUClient:
-    def __init__(self, pos_id: str, client_secret: str, app_base_url: str):
+    def __init__(self, pos_id: str, client_secret: str, app_base_url: str, *, base_url: str = PAYU_BASE_URL):
         self.pos_id = pos_id
         self.client_secret = client_secret
         self.app_base_url = app_base_url.rstrip("/")
+        self.oauth_url = base_url.rstrip("/") + OAUTH_PATH
+        self.orders_url = base_url.rstrip("/") + ORDERS_PATH
         self._token: Optional[str] = None
         self._token_exp: float = 0.0
 
@@ -21,13 +91,12 @@ class PayUClient:
         if self._token and now < self._token_exp - 30:
             return self._token
 
-        auth = base64.b64encode(f"{self.pos_id}:{self.client_secret}".encode()).decode()
         headers = {
-            "Authorization": f"Basic {auth}",
+            "Authorization": f"Basic {_basic_auth(self.pos_id, self.client_secret)}",
             "Content-Type": "application/x-www-form-urlencoded",
         }
         data = {"grant_type": "client_credentials"}
-        resp = requests.post(PAYU_OAUTH_URL, headers=headers, data=data, timeout=15)
+        resp = requests.post(self.oauth_url, headers=headers, data=data, timeout=15)
         resp.raise_for_status()
         body = resp.json()
         self._token = body["access_token"]
@@ -42,28 +111,226 @@ class PayUClient:
         customer_ip: str = "127.0.0.1",
         product_name: str = "Order",
         currency: str = "PLN",
+        ext_order_id: Optional[str] = None,
+        products: Optional[List[Dict[str, Any]]] = None,
     ) -> Dict[str, Any]:
         token = self._get_access_token()
-        payload = {
-            "notifyUrl": f"{self.app_base_url}/payu/notify",
-            "continueUrl": f"{self.app_base_url}/return",
-            "customerIp": customer_ip,
-            "merchantPosId": self.pos_id,
-            "description": description,
-            "currencyCode": currency,
-            "totalAmount": str(total_amount_grosze),
-            "products": [
-                {
-                    "name": product_name,
-                    "unitPrice": str(total_amount_grosze),
-                    "quantity": "1",
-                }
-            ],
-        }
+        payload = _order_payload(
+            pos_id=self.pos_id,
+            app_base_url=self.app_base_url,
+            total_amount_grosze=total_amount_grosze,
+            description=description,
+            customer_ip=customer_ip,
+            product_name=product_name,
+            currency=currency,
+            ext_order_id=ext_order_id,
+            products=products,
+        )
         headers = {
             "Authorization": f"Bearer {token}",
             "Content-Type": "application/json",
         }
-        resp = requests.post(PAYU_ORDERS_URL, json=payload, headers=headers, timeout=20)
+        resp = requests.post(self.orders_url, json=payload, headers=headers, timeout=20)
         resp.raise_for_status()
         return resp.json()
+
+
+def _raise_for_status(resp: httpx.Response) -> None:
+    # PayU answers a created order with 302 + JSON body, which httpx treats as an error.
+    if resp.status_code != 302:
+        resp.raise_for_status()
+
+
+# Non-blocking variant of PayUClient with a shared keep-alive connection pool.
+# Owners must call aclose() (the app does it in its lifespan).
+class AsyncPayUClient:
+    def __init__(
+        self,
+        pos_id: str,
+        client_secret: str,
+        app_base_url: str,
+        *,
+        max_connections: int = 20,
+        max_keepalive: int = 10,
+        timeout: float = 20.0,
+        connect_timeout: float = 5.0,
+        token_cache: Optional[TokenCache] = None,
+        base_url: str = PAYU_BASE_URL,
+        retry: Optional[RetryPolicy] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        limiter: Optional[TokenBucket] = None,
+    ):
+        self.pos_id = pos_id
+        self.oauth_url = base_url.rstrip("/") + OAUTH_PATH
+        self.orders_url = base_url.rstrip("/") + ORDERS_PATH
+        self._tokens = token_cache or TokenCache()
+        self.configure(client_secret, app_base_url)
+        self.retry = retry or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self.limiter = limiter
+        self._http = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive,
+            ),
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            follow_redirects=False,
+        )
+
+    def configure(self, client_secret: str, app_base_url: str) -> None:
+        # Applies changed settings in place, keeping the connection pool and
+        # circuit breaker of this POS.
+        self.client_secret = client_secret
+        self.app_base_url = app_base_url.rstrip("/")
+        # Keyed on the secret too, so changed credentials never reuse an old token.
+        digest = hashlib.sha256(f"{self.pos_id}:{client_secret}".encode()).hexdigest()[:16]
+        self._token_key = f"{self.pos_id}:{digest}"
+
+    async def warm_up(self) -> None:
+        # Fetches (or loads the shared) access token, which also opens a
+        # pooled connection, so the first order does not pay for either.
+        await self._get_access_token()
+
+    async def aclose(self) -> None:
+        await self._http.aclose()
+
+    async def _request(self, call: str, method: str, url: str, **kwargs) -> httpx.Response:
+        status_code = 0
+        try:
+            with metrics.payu_requests.time(call=call):
+                resp = await self._http.request(method, url, **kwargs)
+            status_code = resp.status_code
+            return resp
+        finally:
+            metrics.payu_responses.inc(call=call, status_code=status_code)
+
+    async def _call(
+        self, call: str, method: str, url: str, *, idempotent: bool, admit: bool = False, **kwargs
+    ) -> httpx.Response:
+        # Retries transient failures with jittered backoff and feeds the
+        # circuit breaker. Non-idempotent calls are only retried when PayU
+        # cannot have processed them (connection never made, 429/503). With
+        # `admit`, every attempt, retries included, passes the rate limiter.
+        attempt = 0
+        while True:
+            attempt += 1
+            # Breaker first: while PayU is down, calls fail fast instead of
+            # queueing for (and spending) rate-limit tokens.
+            try:
+                probe = self.breaker.before_call()
+            except CircuitOpenError:
+                metrics.payu_circuit_rejected.inc(pos_id=self.pos_id, call=call)
+                raise
+            if admit:
+                try:
+                    await self._admit()
+                except BaseException:
+                    if probe:
+                        self.breaker.release_probe()
+                    raise
+            try:
+                resp = await self._request(call, method, url, **kwargs)
+            except httpx.TransportError as e:
+                self.breaker.record_failure(f"{call}: {type(e).__name__}")
+                if attempt >= self.retry.max_attempts or not (idempotent or isinstance(e, UNSENT_ERRORS)):
+                    raise
+                metrics.payu_retries.inc(call=call, reason=type(e).__name__)
+                await asyncio.sleep(self.retry.delay(attempt))
+                continue
+            except Exception as e:
+                self.breaker.record_failure(f"{call}: {type(e).__name__}")
+                raise
+            except BaseException:
+                # Cancelled: no outcome to record, but a probe must not stay in flight.
+                if probe:
+                    self.breaker.release_probe()
+                raise
+            if resp.status_code not in TRANSIENT_STATUSES:
+                self.breaker.record_success()
+                return resp
+            self.breaker.record_failure(f"{call}: HTTP {resp.status_code}")
+            if attempt >= self.retry.max_attempts or not (idempotent or resp.status_code in REJECTED_STATUSES):
+                return resp
+            metrics.payu_retries.inc(call=call, reason=str(resp.status_code))
+            await asyncio.sleep(self.retry.delay(attempt, resp.headers.get("Retry-After")))
+
+    async def _admit(self) -> None:
+        # Keeps order creation within the POS's PayU request quota.
+        if self.limiter is None:
+            return
+        try:
+            waited = await self.limiter.acquire()
+        except RateLimitedError:
+            metrics.payu_rate_limited.inc(pos_id=self.pos_id)
+            raise
+        metrics.payu_admission_wait.observe(waited, pos_id=self.pos_id)
+
+    async def _authorized_call(self, call: str, method: str, url: str, *, idempotent: bool, **kwargs) -> httpx.Response:
+        token = await self._get_access_token()
+        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+        resp = await self._call(call, method, url, idempotent=idempotent, headers=headers, **kwargs)
+        if resp.status_code == 401:
+            # Token revoked or expired early: drop it and retry once with a fresh one.
+            self._tokens.invalidate(self._token_key, token)
+            headers["Authorization"] = f"Bearer {await self._get_access_token()}"
+            resp = await self._call(call, method, url, idempotent=idempotent, headers=headers, **kwargs)
+        return resp
+
+    async def _get_access_token(self) -> str:
+        return await self._tokens.get(self._token_key, self._fetch_access_token)
+
+    async def _fetch_access_token(self) -> Tuple[str, int]:
+        headers = {
+            "Authorization": f"Basic {_basic_auth(self.pos_id, self.client_secret)}",
+            "Content-Type": "application/x-www-form-urlencoded",
+        }
+        data = {"grant_type": "client_credentials"}
+        resp = await self._call("oauth", "POST", self.oauth_url, idempotent=True, headers=headers, data=data)
+        _raise_for_status(resp)
+        body = resp.json()
+        return body["access_token"], int(body.get("expires_in", 300))
+
+    async def create_order(
+        self,
+        *,
+        total_amount_grosze: int,
+        description: str,
+        customer_ip: str = "127.0.0.1",
+        product_name: str = "Order",
+        currency: str = "PLN",
+        ext_order_id: Optional[str] = None,
+        products: Optional[List[Dict[str, Any]]] = None,
+    ) -> Dict[str, Any]:
+        payload = _order_payload(
+            pos_id=self.pos_id,
+            app_base_url=self.app_base_url,
+            total_amount_grosze=total_amount_grosze,
+            description=description,
+            customer_ip=customer_ip,
+            product_name=product_name,
+            currency=currency,
+            ext_order_id=ext_order_id,
+            products=products,
+        )
+        resp = await self._authorized_call(
+            "create_order", "POST", self.orders_url, idempotent=False, admit=True, json=payload
+        )
+        _raise_for_status(resp)
+        return resp.json()
+
+    async def create_orders(self, orders: List[Dict[str, Any]], *, concurrency: int = 5) -> List[Any]:
+        # orders: create_order keyword arguments. At most `concurrency` calls
+        # are in flight (all still pass the rate limiter). Returns, in order,
+        # each order's PayU response or the exception it raised.
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def create(order: Dict[str, Any]) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.create_order(**order)
+
+        return await asyncio.gather(*(create(order) for order in orders), return_exceptions=True)
+
+    async def get_order(self, order_id: str) -> Dict[str, Any]:
+        resp = await self._authorized_call("get_order", "GET", f"{self.orders_url}/{order_id}", idempotent=True)
+        _raise_for_status(resp)
+        return resp.json()
@@ -0,0 +1,170 @@
+import asyncio
+import datetime
+import logging
+import os
+import socket
+import time
+from typing import Callable, Dict, Optional
+
+import httpx
+
+from . import metrics
+from .db import acquire_lease, apply_order_statuses, get_pending_transactions
+from .notify import ORDER_STATUS_RANK, TERMINAL_STATUSES, should_apply
+from .resilience import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# "SUCCESS" is what /pay records for a created order before PayU reports on it.
+PENDING_STATUSES = ["SUCCESS"] + [s for s in ORDER_STATUS_RANK if s not in TERMINAL_STATUSES]
+
+
+class RatePacer:
+    # Spaces call starts at least 1/rate seconds apart across all callers.
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            if self._next > now:
+                await asyncio.sleep(self._next - now)
+                now = self._next
+            self._next = now + self.interval
+
+
+class Reconciler:
+    # Periodically asks PayU for the status of orders still pending here
+    # (e.g. when a notification was lost) and writes changes back in batches.
+    # PayU calls are limited to `concurrency` at a time and `rate` per second,
+    # so a large backlog drains slowly instead of crowding out /pay. Only the
+    # worker holding the "reconciler" lease runs a pass. get_client(pos_id)
+    # returns the client for the POS that created an order (None: skip it).
+    def __init__(
+        self,
+        get_client: Callable[[Optional[str]], Optional[object]],
+        *,
+        interval: float = 60.0,
+        batch_size: int = 500,
+        concurrency: int = 4,
+        rate: float = 5.0,
+        min_age: float = 300.0,
+        max_age: float = 7 * 86400.0,
+    ):
+        self.get_client = get_client
+        self.interval = interval
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.rate = rate
+        self.min_age = min_age
+        self.max_age = max_age
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._task: Optional[asyncio.Task] = None
+        self.last_run: Dict[str, object] = {}
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Order reconciliation pass failed")
+            await asyncio.sleep(self.interval)
+
+    async def _hold_lease(self) -> bool:
+        # Renewed before every page; it outlives one interval, so a busy owner keeps it.
+        return await asyncio.to_thread(acquire_lease, "reconciler", self.owner, self.interval * 3)
+
+    async def run_once(self) -> Dict[str, object]:
+        if not await self._hold_lease():
+            return {}
+        started = time.monotonic()
+        now = datetime.datetime.utcnow()
+        created_after = now - datetime.timedelta(seconds=self.max_age)
+        created_before = now - datetime.timedelta(seconds=self.min_age)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        pacer = RatePacer(self.rate)
+        checked = updated = errors = 0
+        cursor = None
+
+        async def fetch_status(order_id: str, pos_id: Optional[str]) -> Optional[str]:
+            nonlocal errors
+            client = self.get_client(pos_id)
+            if client is None:
+                # POS no longer configured.
+                return None
+            async with semaphore:
+                await pacer.wait()
+                try:
+                    body = await client.get_order(order_id)
+                except CircuitOpenError:
+                    raise
+                except (httpx.HTTPError, ValueError):
+                    errors += 1
+                    return None
+            orders = body.get("orders") or []
+            return orders[0].get("status") if orders else None
+
+        while True:
+            rows = await asyncio.to_thread(
+                get_pending_transactions, PENDING_STATUSES, created_after, created_before, cursor, self.batch_size
+            )
+            if not rows:
+                break
+            cursor = (rows[-1].created_at, rows[-1].id)
+            current = {row.order_id: row.status for row in rows}
+            pos_ids = {row.order_id: row.pos_id for row in rows}
+            order_ids = list(current)
+            tasks = [asyncio.create_task(fetch_status(order_id, pos_ids[order_id])) for order_id in order_ids]
+            try:
+                statuses = await asyncio.gather(*tasks)
+            except BaseException as e:
+                # gather() leaves the other lookups running when one fails (or
+                # when run_once is cancelled mid-page); they must not outlive it.
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                if isinstance(e, CircuitOpenError):
+                    # PayU is unhealthy; try again next interval.
+                    break
+                raise
+            checked += len(order_ids)
+            updates = {
+                order_id: status
+                for order_id, status in zip(order_ids, statuses)
+                if status and should_apply(current[order_id], status)
+            }
+            if updates:
+                await asyncio.to_thread(apply_order_statuses, updates, should_apply)
+                updated += len(updates)
+            metrics.reconciled_orders.inc(len(order_ids), result="checked")
+            metrics.reconciled_orders.inc(len(updates), result="updated")
+            if len(rows) < self.batch_size or not await self._hold_lease():
+                break
+
+        self.last_run = {
+            "at": now,
+            "checked": checked,
+            "updated": updated,
+            "errors": errors,
+            "duration_s": round(time.monotonic() - started, 3),
+        }
+        return self.last_run
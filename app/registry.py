@@ -0,0 +1,196 @@
+import asyncio
+import json
+import logging
+import re
+from typing import Callable, Dict, List, Optional, Set
+
+from . import metrics
+from .db import DEFAULT_CURRENCY
+
+logger = logging.getLogger(__name__)
+
+CURRENCY_PATTERN = re.compile(r"^[A-Z]{3}$")
+# In-flight calls on a removed POS get this long to finish before its pool closes.
+RETIRE_GRACE = 30.0
+_CIRCUIT_STATES = {"closed": 0, "half-open": 1, "open": 2}
+
+
+def parse_extra_pos(raw: str) -> List[Dict[str, str]]:
+    # PAYU_POS_EXTRA: a JSON list of {"pos_id", "client_secret", "second_key",
+    # "currency", "merchant"}; the last three are optional. Raises ValueError.
+    entries = json.loads(raw or "[]")
+    if not isinstance(entries, list):
+        raise ValueError("Additional POS must be a JSON list")
+    configs = []
+    for entry in entries:
+        if not isinstance(entry, dict) or not entry.get("pos_id") or not entry.get("client_secret"):
+            raise ValueError("Each additional POS needs pos_id and client_secret")
+        currency = str(entry.get("currency") or DEFAULT_CURRENCY).upper()
+        if not CURRENCY_PATTERN.match(currency):
+            raise ValueError(f"Invalid currency: {currency}")
+        configs.append({
+            "pos_id": str(entry["pos_id"]),
+            "client_secret": str(entry["client_secret"]),
+            "second_key": str(entry.get("second_key") or ""),
+            "currency": currency,
+            "merchant": str(entry.get("merchant") or ""),
+        })
+    return configs
+
+
+def pos_configs(settings: dict) -> List[Dict[str, str]]:
+    # The POS from the classic settings comes first and is the default.
+    configs = []
+    if settings.get("PAYU_POS_ID") and settings.get("PAYU_CLIENT_SECRET"):
+        configs.append({
+            "pos_id": settings["PAYU_POS_ID"],
+            "client_secret": settings["PAYU_CLIENT_SECRET"],
+            "second_key": settings.get("PAYU_SECOND_KEY") or "",
+            "currency": DEFAULT_CURRENCY,
+            "merchant": "",
+        })
+    try:
+        extra = parse_extra_pos(settings.get("PAYU_POS_EXTRA") or "")
+    except ValueError:
+        logger.exception("Ignoring invalid PAYU_POS_EXTRA setting")
+        extra = []
+    seen = {c["pos_id"] for c in configs}
+    for config in extra:
+        if config["pos_id"] not in seen:
+            seen.add(config["pos_id"])
+            configs.append(config)
+    return configs
+
+
+class PayURegistry:
+    # One AsyncPayUClient per POS ID, each with its own connection pool and
+    # circuit breaker. sync() diffs the settings against the running clients:
+    # changed ones are reconfigured in place, new ones are built and warmed
+    # up in the background, removed ones are closed after a grace period.
+    def __init__(self, factory: Callable[[str, str, str], object]):
+        self.factory = factory
+        self._clients: Dict[str, object] = {}
+        self._configs: Dict[str, Dict[str, str]] = {}
+        self._default: Optional[str] = None
+        self._settings: Optional[dict] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._retired: List[object] = []
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    def clients(self) -> List[object]:
+        return list(self._clients.values())
+
+    def sync(self, settings: dict, warm_up: bool = True) -> None:
+        # Cheap when nothing changed: the settings cache hands out the same dict.
+        # warm_up=False leaves new and rotated clients cold (startup decides itself).
+        if settings is self._settings:
+            return
+        self._settings = settings
+        app_base_url = settings.get("APP_BASE_URL") or "http://localhost:8000"
+        configs = {c["pos_id"]: c for c in pos_configs(settings)}
+        for pos_id in list(self._clients):
+            if pos_id not in configs:
+                self._retire(pos_id)
+        for pos_id, config in configs.items():
+            client = self._clients.get(pos_id)
+            if client is None:
+                client = self.factory(pos_id, config["client_secret"], app_base_url)
+                self._clients[pos_id] = client
+                metrics.payu_circuit_state.set_function(
+                    lambda client=client: _CIRCUIT_STATES[client.breaker.state], pos_id=pos_id
+                )
+                if client.limiter is not None:
+                    metrics.payu_admission_queue.set_function(lambda client=client: client.limiter.waiting, pos_id=pos_id)
+                if warm_up:
+                    self._spawn(self._warm_up(client))
+            elif (client.client_secret, client.app_base_url) != (config["client_secret"], app_base_url.rstrip("/")):
+                rotated = client.client_secret != config["client_secret"]
+                client.configure(config["client_secret"], app_base_url)
+                if rotated and warm_up:
+                    self._spawn(self._warm_up(client))
+        self._configs = configs
+        self._default = next(iter(configs), None)
+
+    def get(self, pos_id: Optional[str] = None):
+        # None (e.g. rows written before POS IDs were recorded) means the default POS.
+        return self._clients.get(pos_id or self._default or "")
+
+    def second_key(self, pos_id: Optional[str] = None) -> str:
+        config = self._configs.get(pos_id or self._default or "")
+        if config is None:
+            return ""
+        # Older setups only stored the client secret.
+        return config["second_key"] or config["client_secret"]
+
+    def route(self, currency: str = "", merchant: str = ""):
+        # Picks the POS for a payment: by merchant name when given, otherwise
+        # the default POS if it takes the currency, otherwise the first that
+        # does. Raises LookupError when none matches, including a merchant
+        # whose POS takes another currency.
+        currency = (currency or DEFAULT_CURRENCY).upper()
+        if merchant:
+            for pos_id, config in self._configs.items():
+                if config["merchant"] == merchant:
+                    if config["currency"] != currency:
+                        raise LookupError(f"Merchant {merchant} takes {config['currency']}, not {currency}")
+                    return self._clients[pos_id]
+            raise LookupError(f"Unknown merchant: {merchant}")
+        for pos_id, config in self._configs.items():
+            if config["currency"] == currency:
+                return self._clients[pos_id]
+        raise LookupError(f"No PayU POS configured for {currency}")
+
+    async def warm_up(self, timeout: Optional[float] = None) -> None:
+        # Warms every client concurrently; those still going after `timeout`
+        # carry on in the background.
+        tasks = [asyncio.create_task(self._warm_up(client)) for client in self._clients.values()]
+        for task in tasks:
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+    async def aclose(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for pos_id in list(self._clients):
+            self._remove_metrics(pos_id)
+            self._retired.append(self._clients.pop(pos_id))
+        while self._retired:
+            await self._retired.pop().aclose()
+        self._settings = None
+
+    def _retire(self, pos_id: str) -> None:
+        client = self._clients.pop(pos_id)
+        self._remove_metrics(pos_id)
+        self._retired.append(client)
+        self._spawn(self._close_later(client))
+
+    def _remove_metrics(self, pos_id: str) -> None:
+        metrics.payu_circuit_state.remove(pos_id=pos_id)
+        metrics.payu_admission_queue.remove(pos_id=pos_id)
+
+    def _spawn(self, coro) -> None:
+        try:
+            task = asyncio.get_running_loop().create_task(coro)
+        except RuntimeError:
+            # No event loop yet; warm_up() runs at startup.
+            coro.close()
+            return
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _warm_up(self, client) -> None:
+        try:
+            await client.warm_up()
+        except Exception as e:
+            logger.warning("PayU warm-up failed for POS %s: %s", client.pos_id, e)
+
+    async def _close_later(self, client) -> None:
+        await asyncio.sleep(RETIRE_GRACE)
+        if client in self._retired:
+            self._retired.remove(client)
+            await client.aclose()
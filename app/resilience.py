@@ -0,0 +1,145 @@
+import asyncio
+import random
+import time
+from typing import Dict, Optional
+
+import httpx
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+# Statuses worth retrying. Only 429 and 503 say the request was not processed,
+# so those are the only ones retried for non-idempotent calls.
+TRANSIENT_STATUSES = {429, 500, 502, 503, 504}
+REJECTED_STATUSES = {429, 503}
+# Transport errors raised before the request reached PayU.
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"PayU circuit breaker open, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class RateLimitedError(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"PayU request rate limit reached, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    # Admits `rate` calls per second with bursts of up to `burst`. A caller
+    # that finds the bucket empty reserves the next token and sleeps until it
+    # is due, so waiters are served in arrival order. When max_waiters are
+    # already queued, or the wait would exceed max_wait seconds, acquire()
+    # fails fast with RateLimitedError instead.
+    def __init__(self, rate: float, burst: int, *, max_waiters: int = 100, max_wait: float = 2.0):
+        self.rate = rate
+        self.burst = burst
+        self.max_waiters = max_waiters
+        self.max_wait = max_wait
+        self.tokens = float(burst)
+        self.waiting = 0
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> float:
+        # Returns the seconds spent waiting.
+        now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        wait = (1 - self.tokens) / self.rate
+        if self.waiting >= self.max_waiters or wait > self.max_wait:
+            raise RateLimitedError(max(wait, 1.0))
+        self.tokens -= 1
+        self.waiting += 1
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            # Hand the reserved token back to the callers behind us.
+            self.tokens += 1
+            raise
+        finally:
+            self.waiting -= 1
+        return wait
+
+
+class CircuitBreaker:
+    # Opens after failure_threshold consecutive upstream failures and fails
+    # calls fast for reset_timeout seconds. Then one probe call is let through
+    # (half-open): success closes the circuit, failure opens it again.
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.last_error = ""
+        self._probe_in_flight = False
+
+    def before_call(self) -> bool:
+        # Returns True when this call is the half-open probe.
+        if self.state == CLOSED:
+            return False
+        remaining = self.opened_at + self.reset_timeout - time.monotonic()
+        if self.state == OPEN and remaining <= 0:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        raise CircuitOpenError(max(remaining, 1.0))
+
+    def release_probe(self) -> None:
+        # The probe ended without an outcome (e.g. it was cancelled); the next
+        # call probes instead.
+        self._probe_in_flight = False
+
+    def record_success(self) -> None:
+        self.state = CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self, error: str) -> None:
+        self.failures += 1
+        self.last_error = error
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def snapshot(self) -> Dict[str, object]:
+        retry_in = 0.0
+        if self.state == OPEN:
+            retry_in = max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "failure_threshold": self.failure_threshold,
+            "retry_in": retry_in,
+            "last_error": self.last_error,
+        }
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.2, max_delay: float = 2.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        # Full jitter: uniform in [0, base * 2^(attempt-1)], capped, but never
+        # sooner than a Retry-After the server asked for (within max_delay).
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        if retry_after:
+            try:
+                return min(self.max_delay, max(backoff, float(retry_after)))
+            except ValueError:
+                pass
+        return backoff
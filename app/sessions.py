@@ -0,0 +1,77 @@
+import base64
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from typing import AbstractSet, Callable, Optional
+
+_VERSION = "v1"
+
+
+def _sign(key: bytes, payload: str) -> str:
+    digest = hmac.new(key, payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+class SessionSigner:
+    # Stateless admin sessions: "v1.<session id>.<expiry>.<HMAC-SHA256>".
+    # Checking a token needs only the server key, which is loaded once via
+    # `load_key`, so any number of admins can be signed in. Logout stores the
+    # session id through `save_revoked(session_id, expires_at)` until the
+    # token would have expired anyway; `load_revoked()` returns the revoked
+    # ids and must be cheap, as every check calls it.
+    def __init__(
+        self,
+        load_key: Callable[[], str],
+        load_revoked: Callable[[], AbstractSet[str]],
+        save_revoked: Callable[[str, float], None],
+        ttl: float = 3600.0,
+    ):
+        self.load_key = load_key
+        self.load_revoked = load_revoked
+        self.save_revoked = save_revoked
+        self.ttl = ttl
+        self._key: Optional[bytes] = None
+        self._key_lock = threading.Lock()
+
+    def _get_key(self) -> bytes:
+        if self._key is None:
+            with self._key_lock:
+                if self._key is None:
+                    self._key = self.load_key().encode()
+        return self._key
+
+    def issue(self) -> str:
+        payload = f"{_VERSION}.{secrets.token_urlsafe(16)}.{int(time.time() + self.ttl)}"
+        return f"{payload}.{_sign(self._get_key(), payload)}"
+
+    def _parse(self, token: Optional[str]):
+        # (session id, expiry) of a well-formed, correctly signed token, else None.
+        if not token:
+            return None
+        parts = token.split(".")
+        if len(parts) != 4 or parts[0] != _VERSION:
+            return None
+        payload, signature = token.rsplit(".", 1)
+        if not hmac.compare_digest(signature, _sign(self._get_key(), payload)):
+            return None
+        try:
+            return parts[1], int(parts[2])
+        except ValueError:
+            return None
+
+    def verify(self, token: Optional[str]) -> bool:
+        parsed = self._parse(token)
+        if parsed is None:
+            return False
+        session_id, expires_at = parsed
+        return expires_at > time.time() and session_id not in self.load_revoked()
+
+    def revoke(self, token: Optional[str]) -> None:
+        parsed = self._parse(token)
+        if parsed is None:
+            return
+        session_id, expires_at = parsed
+        if expires_at > time.time():
+            self.save_revoked(session_id, expires_at)
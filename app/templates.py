@@ -0,0 +1,346 @@
+import gzip
+import hashlib
+import html
+from string import Template
+from urllib.parse import urlencode
+
+from fastapi import Request
+from fastapi.responses import Response
+
+STYLESHEET = """\
+body { font-family: 'Segoe UI', Arial, sans-serif; background: #f7f7f7; margin: 0; padding: 0; }
+.container { max-width: 900px; margin: 40px auto; background: #fff; border-radius: 8px; box-shadow: 0 2px 8px #0001; padding: 32px; }
+h1, h2 { color: #2c3e50; margin-bottom: 24px; }
+h2.error { color: #c0392b; }
+p, .msg { color: #34495e; font-size: 1.1em; margin-bottom: 24px; }
+a { color: #2980b9; text-decoration: none; }
+a:hover { text-decoration: underline; }
+label { display: block; margin-bottom: 12px; font-weight: 500; color: #34495e; }
+input[type='text'], input[type='password'], textarea { width: 100%; padding: 8px; border: 1px solid #ccc; border-radius: 4px; margin-top: 4px; margin-bottom: 16px; font-size: 1em; box-sizing: border-box; }
+button { background: #2980b9; color: #fff; border: none; padding: 10px 24px; border-radius: 4px; font-size: 1em; cursor: pointer; transition: background 0.2s; }
+button:hover { background: #3498db; }
+button.pay { background: #27ae60; }
+button.pay:hover { background: #2ecc71; }
+.links { margin-top: 32px; }
+.links a { display: inline-block; margin-right: 24px; font-size: 1.1em; font-weight: 500; }
+.info { color: #7f8c8d; font-size: 0.95em; margin-top: 16px; }
+.back { display: inline-block; margin-top: 24px; font-size: 0.95em; }
+.tabs { margin-bottom: 24px; }
+.tab { display: inline-block; margin-right: 16px; font-size: 1em; font-weight: 500; }
+.logout { float: right; color: #c0392b; font-size: 0.95em; font-weight: 500; margin-top: 8px; }
+table { width: 100%; border-collapse: collapse; margin-top: 16px; }
+th, td { border: 1px solid #ccc; padding: 8px; text-align: left; }
+th { background: #2980b9; color: #fff; }
+tr:nth-child(even) { background: #f2f2f2; }
+select { padding: 4px; border: 1px solid #ccc; border-radius: 4px; margin: 0 8px 8px 0; }
+.filters input { width: 120px; padding: 4px; border: 1px solid #ccc; border-radius: 4px; margin: 0 8px 8px 0; }
+.filters button { padding: 5px 16px; }
+.page { display: inline-block; margin: 16px 16px 0 0; }
+.circuit-closed { color: #27ae60; font-weight: 500; }
+.circuit-open, .circuit-half-open { color: #c0392b; font-weight: 500; }
+"""
+
+
+def _etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+
+
+class StaticAsset:
+    # Rendered once; served from memory with an ETag and a pre-gzipped body.
+    def __init__(self, body: str, media_type: str, *, status_code: int = 200, cache_control: str = "no-cache"):
+        self.body = body.encode()
+        self.gzipped = gzip.compress(self.body, compresslevel=9, mtime=0)
+        self.etag = _etag(self.body)
+        self.media_type = media_type
+        self.status_code = status_code
+        self.cache_control = cache_control
+
+    def response(self, request: Request) -> Response:
+        headers = {"ETag": self.etag, "Cache-Control": self.cache_control, "Vary": "Accept-Encoding"}
+        if self.status_code == 200 and self.etag in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+        body = self.body
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            body = self.gzipped
+            headers["Content-Encoding"] = "gzip"
+        return Response(body, status_code=self.status_code, media_type=self.media_type, headers=headers)
+
+
+stylesheet = StaticAsset(STYLESHEET, "text/css", cache_control="public, max-age=31536000, immutable")
+# Content-addressed URL, so the stylesheet can be cached forever.
+STYLESHEET_URL = f"/static/app.css?v={stylesheet.etag.strip(chr(34))}"
+
+_LAYOUT = Template(f"""<!DOCTYPE html>
+<html>
+  <head>
+    <meta charset="utf-8">
+    <title>$title</title>
+    <link rel="stylesheet" href="{STYLESHEET_URL}">
+  </head>
+  <body>
+    <div class="container">
+$content
+    </div>
+  </body>
+</html>
+""")
+
+
+def e(value) -> str:
+    return html.escape("" if value is None else str(value), quote=True)
+
+
+def page(title: str, content: str) -> str:
+    # title is escaped here; content must already be safe HTML.
+    return _LAYOUT.substitute(title=e(title), content=content)
+
+
+home_page = StaticAsset(page("PayU Starter", """\
+      <h1>PayU Starter</h1>
+      <p>
+        Welcome to PayU Starter, a FastAPI MVP for integrating PayU payments.<br>
+        <b>Note:</b> You must first <a href='https://secure.snd.payu.com/'>register for a PayU account</a> and obtain sandbox credentials before using this app.<br>
+        Use the links below to create a payment or manage settings and review transactions in the admin panel.
+      </p>
+      <div class="links">
+        <a href="/pay">Create Payment</a>
+        <a href="/admin">Admin Panel</a>
+      </div>"""), "text/html")
+
+admin_login_page = StaticAsset(page("Admin Login", """\
+      <h2>Admin Login</h2>
+      <form method='post' action='/admin/login'>
+        <label>Password:
+          <input type='password' name='password' placeholder='Enter admin password'/>
+        </label>
+        <button type='submit'>Login</button>
+      </form>"""), "text/html")
+
+login_failed_page = StaticAsset(page("Admin Login - PayU Starter", """\
+      <h2 class="error">Login failed</h2>
+      <p>Incorrect password.</p>
+      <a href='/admin/login'>Try again</a>"""), "text/html", status_code=401)
+
+setup_required_page = StaticAsset(page("PayU Starter - Setup Required", """\
+      <h2 class="error">PayU Starter - Setup Required</h2>
+      <p>PayU credentials are not set.</p>
+      <p>Please go to <a href='/admin'>Admin Settings</a> to configure PAYU_POS_ID and PAYU_CLIENT_SECRET.</p>"""), "text/html")
+
+pay_page = StaticAsset(page("PayU Starter - Create Payment", """\
+      <h2>Create PayU Payment (Sandbox)</h2>
+      <form method="post" action="/pay">
+        <label>Amount:
+          <input type="text" name="amount_pln" value="12.34" placeholder="e.g. 12.34" />
+        </label>
+        <label>Currency:
+          <input type="text" name="currency" value="PLN" maxlength="3" placeholder="e.g. PLN" />
+        </label>
+        <label>Description:
+          <input type="text" name="description" value="Test payment" size="40" placeholder="e.g. Test payment"/>
+        </label>
+        <input type="hidden" name="idempotency_key" id="idempotency_key"/>
+        <button class="pay" type="submit">Pay with PayU</button>
+      </form>
+      <script>
+        // One key per page view: double submits reuse the first order.
+        function newIdempotencyKey() {
+          document.getElementById('idempotency_key').value = window.crypto && crypto.randomUUID
+            ? crypto.randomUUID() : Date.now().toString(36) + Math.random().toString(36).slice(2);
+        }
+        newIdempotencyKey();
+        window.addEventListener('pageshow', function (e) { if (e.persisted) newIdempotencyKey(); });
+      </script>
+      <div class="info">After payment, you will be redirected back to <b>/return</b>.</div>
+      <a class="back" href="/admin">Admin Settings</a>"""), "text/html")
+
+
+_ERROR = Template("""\
+      <h2 class="error">Error $status_code</h2>
+      <div class="msg">$detail</div>
+      <a class="back" href="/">← Back to Home</a>""")
+
+
+def render_error(status_code: int, detail) -> str:
+    return page("Error", _ERROR.substitute(status_code=e(status_code), detail=e(detail)))
+
+
+_ADMIN_NAV = """\
+      <h2>PayU Settings (Admin)
+        <a class="logout" href="/admin/logout">Logout</a>
+      </h2>
+      <div class="tabs">
+        <a class="tab" href="/admin">Settings</a>
+        <a class="tab" href="/admin/transactions">Transactions</a>
+        <a class="tab" href="/admin/dashboard">Dashboard</a>
+      </div>"""
+
+_ADMIN_SETTINGS = Template(_ADMIN_NAV + """
+      <form method='post' action='/admin'>
+        <label>PAYU_POS_ID:
+          <input type='text' name='pos_id' value='$pos_id' placeholder='Enter POS ID'/>
+        </label>
+        <label>PAYU_CLIENT_SECRET:
+          <input type='text' name='client_secret' value='$client_secret' placeholder='Enter Client Secret'/>
+        </label>
+        <label>PAYU_SECOND_KEY (MD5, for notification signatures):
+          <input type='text' name='second_key' value='$second_key' placeholder='Enter Second Key'/>
+        </label>
+        <label>APP_BASE_URL:
+          <input type='text' name='app_base_url' value='$app_base_url' placeholder='http://localhost:8000'/>
+        </label>
+        <label>Additional POS (JSON list; the POS above is the default, for PLN):
+          <textarea name='extra_pos' rows='4' placeholder='[{"pos_id": "...", "client_secret": "...", "second_key": "...", "currency": "EUR", "merchant": "brand-b"}]'>$extra_pos</textarea>
+        </label>
+        <button type='submit'>Save Settings</button>
+      </form>
+      $upstream
+      <a class='back' href='/'>← Back to Home</a>""")
+
+_UPSTREAM = Template("""<div class="info">PayU upstream (POS $pos_id): <span class="circuit-$state">$state</span>
+        ($failures/$threshold consecutive failures$retry_in)$last_error</div>""")
+
+
+def render_admin_settings(pos_id, client_secret, second_key, app_base_url, extra_pos="", breakers=()) -> str:
+    # breakers: [(pos_id, CircuitBreaker.snapshot())]
+    upstream = "".join(
+        _UPSTREAM.substitute(
+            pos_id=e(breaker_pos_id),
+            state=e(breaker["state"]),
+            failures=breaker["failures"],
+            threshold=breaker["failure_threshold"],
+            retry_in=f", retry in {breaker['retry_in']:.0f}s" if breaker["retry_in"] else "",
+            last_error=f"<br>Last error: {e(breaker['last_error'])}" if breaker["last_error"] else "",
+        )
+        for breaker_pos_id, breaker in breakers
+    )
+    return page("Admin Settings", _ADMIN_SETTINGS.substitute(
+        pos_id=e(pos_id),
+        client_secret=e(client_secret),
+        second_key=e(second_key),
+        app_base_url=e(app_base_url),
+        extra_pos=e(extra_pos),
+        upstream=upstream,
+    ))
+
+
+_TRANSACTION_ROW = Template(
+    "<tr><td>$id</td><td>$order_id</td><td>$amount $currency</td><td>$description</td><td>$status</td><td>$created_at</td></tr>"
+)
+
+_TRANSACTIONS = Template("""\
+      <h2>Payment Transactions</h2>
+      <form class="filters" method="get" action="/admin/transactions">
+        <input type="text" name="status" value="$status" placeholder="Status"/>
+        <input type="text" name="order_id" value="$order_id" placeholder="Order ID"/>
+        <input type="text" name="min_amount" value="$min_amount" placeholder="Min amount"/>
+        <input type="text" name="max_amount" value="$max_amount" placeholder="Max amount"/>
+        <input type="date" name="date_from" value="$date_from"/>
+        <input type="date" name="date_to" value="$date_to"/>
+        <button type="submit">Filter</button>
+      </form>
+      <table>
+        <tr><th>ID</th><th>Order ID</th><th>Amount</th><th>Description</th><th>Status</th><th>Created At</th></tr>
+        $rows
+      </table>
+      <a class='page' href='$first_link'>First page</a>
+      $next_link
+      <a class='page' href='$export_csv'>Export CSV</a>
+      <a class='page' href='$export_ndjson'>Export NDJSON</a>
+      <br>
+      <a class='back' href='/admin'>← Back to Admin</a>""")
+
+
+def render_transactions(txs, filters: dict, first_link: str, next_link: str = "") -> str:
+    rows = "".join(
+        _TRANSACTION_ROW.substitute(
+            id=tx.id,
+            order_id=e(tx.order_id),
+            amount=f"{tx.amount/100:.2f}",
+            currency=e(tx.currency or "PLN"),
+            description=e(tx.description),
+            status=e(tx.status),
+            created_at=tx.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        )
+        for tx in txs
+    )
+    next_html = f"<a class='page' href='{e(next_link)}'>Next page →</a>" if next_link else ""
+    active = {k: v for k, v in filters.items() if v}
+    return page("Payment Transactions", _TRANSACTIONS.substitute(
+        rows=rows,
+        first_link=e(first_link),
+        next_link=next_html,
+        export_csv=e("/admin/transactions/export?" + urlencode({**active, "format": "csv"})),
+        export_ndjson=e("/admin/transactions/export?" + urlencode({**active, "format": "ndjson"})),
+        **{k: e(v) for k, v in filters.items()},
+    ))
+
+
+_DASHBOARD_ROW = Template(
+    "<tr><td>$period</td><td>$currency</td><td>$orders</td><td>$amount</td><td>$completed</td><td>$paid</td>"
+    "<td>$pending</td><td>$canceled</td><td>$errors</td></tr>"
+)
+
+_DASHBOARD = Template(_ADMIN_NAV + """
+      <form class="filters" method="get" action="/admin/dashboard">
+        <input type="text" name="days" value="$days" placeholder="Days"/>
+        <select name="granularity">
+          <option value="day"$day_selected>Per day</option>
+          <option value="hour"$hour_selected>Per hour</option>
+        </select>
+        <button type="submit">Show</button>
+      </form>
+      <table>
+        <tr><th>Period (UTC)</th><th>Currency</th><th>Orders</th><th>Amount</th><th>Completed</th><th>Paid</th><th>Pending</th><th>Canceled</th><th>Errors</th></tr>
+        $rows
+      </table>
+      <a class='back' href='/admin'>← Back to Admin</a>""")
+
+
+def _dashboard_row(period, currency, outcomes) -> str:
+    def orders(*names):
+        return sum(outcomes.get(n, (0, 0))[0] for n in names)
+
+    def amount(*names):
+        return f"{sum(outcomes.get(n, (0, 0))[1] for n in names) / 100:.2f}"
+
+    return _DASHBOARD_ROW.substitute(
+        period=e(period),
+        currency=e(currency),
+        orders=orders(*outcomes),
+        amount=amount(*outcomes),
+        completed=orders("completed"),
+        paid=amount("completed"),
+        pending=orders("pending"),
+        canceled=orders("canceled"),
+        errors=orders("error"),
+    )
+
+
+def render_dashboard(periods, days: int, granularity: str) -> str:
+    # periods: [(period, currency, {outcome: (orders, amount)})], newest
+    # first. Amounts are never added across currencies.
+    totals = {}
+    for _, currency, outcomes in periods:
+        for outcome, (orders, amount) in outcomes.items():
+            o, a = totals.setdefault(currency, {}).get(outcome, (0, 0))
+            totals[currency][outcome] = (o + orders, a + amount)
+    rows = "".join(_dashboard_row(period, currency, outcomes) for period, currency, outcomes in periods)
+    for currency in sorted(totals):
+        rows += _dashboard_row("Total", currency, totals[currency]).replace("<td>", "<th>").replace("</td>", "</th>")
+    return page("Revenue Dashboard", _DASHBOARD.substitute(
+        days=days,
+        day_selected=" selected" if granularity == "day" else "",
+        hour_selected=" selected" if granularity == "hour" else "",
+        rows=rows,
+    ))
+
+
+_RETURN = Template("""\
+      <h2>Payment flow finished (sandbox)</h2>
+      <p>Order ID (if known): $order_id</p>
+      <p>Check your PayU sandbox panel for final status.</p>
+      <a class="back" href="/">Back</a>""")
+
+
+def render_return(order_id) -> str:
+    return page("PayU Starter - Payment finished", _RETURN.substitute(order_id=e(order_id)))
@@ -0,0 +1,174 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from . import metrics
+
+# fetch() returns (access_token, expires_in_seconds)
+TokenFetcher = Callable[[], Awaitable[Tuple[str, int]]]
+
+
+class SQLiteTokenStore:
+    # Shares OAuth tokens between worker processes on the same host. The
+    # lease column makes sure only one worker talks to the OAuth endpoint
+    # at a time; the others wait for it to publish the new token.
+    def __init__(self, path: str):
+        self.path = path
+        self._ready = False
+        self._ready_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        # The file and table are set up on first use, not at import.
+        if not self._ready:
+            with self._ready_lock:
+                if not self._ready:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS oauth_tokens ("
+                        " key TEXT PRIMARY KEY,"
+                        " token TEXT,"
+                        " expires_at REAL NOT NULL DEFAULT 0,"
+                        " lease_until REAL NOT NULL DEFAULT 0)"
+                    )
+                    self._ready = True
+        return conn
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT token, expires_at FROM oauth_tokens WHERE key = ? AND token IS NOT NULL",
+                (key,),
+            ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def acquire_lease(self, key: str, ttl: float) -> bool:
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO oauth_tokens (key) VALUES (?)", (key,))
+            cur = conn.execute(
+                "UPDATE oauth_tokens SET lease_until = ? WHERE key = ? AND lease_until < ?",
+                (now + ttl, key, now),
+            )
+            return cur.rowcount == 1
+
+    def release_lease(self, key: str) -> None:
+        with self._connect() as conn:
+            conn.execute("UPDATE oauth_tokens SET lease_until = 0 WHERE key = ?", (key,))
+
+    def put(self, key: str, token: str, expires_at: float) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO oauth_tokens (key, token, expires_at, lease_until) VALUES (?, ?, ?, 0)"
+                " ON CONFLICT(key) DO UPDATE SET token = excluded.token,"
+                " expires_at = excluded.expires_at, lease_until = 0",
+                (key, token, expires_at),
+            )
+
+
+class TokenCache:
+    # Single-flight OAuth token cache. Tokens are refreshed in the background
+    # once they are within refresh_margin seconds of expiry and are never
+    # handed out with less than min_validity seconds left.
+    def __init__(
+        self,
+        store: Optional[SQLiteTokenStore] = None,
+        *,
+        refresh_margin: float = 60.0,
+        min_validity: float = 30.0,
+        lease_ttl: float = 10.0,
+    ):
+        self._store = store
+        self.refresh_margin = refresh_margin
+        self.min_validity = min_validity
+        self.lease_ttl = lease_ttl
+        self._tokens: Dict[str, Tuple[str, float]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._background: Dict[str, asyncio.Task] = {}
+        # Tokens PayU refused; never taken back from the shared store.
+        self._rejected: Dict[str, str] = {}
+
+    def _usable(self, entry: Optional[Tuple[str, float]], margin: float) -> bool:
+        return bool(entry) and time.time() < entry[1] - margin
+
+    def _usable_shared(self, key: str, entry: Optional[Tuple[str, float]]) -> bool:
+        return self._usable(entry, self.refresh_margin) and entry[0] != self._rejected.get(key)
+
+    def _lock(self, key: str) -> asyncio.Lock:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    def invalidate(self, key: str, token: Optional[str] = None) -> None:
+        entry = self._tokens.get(key)
+        if token is None or (entry and entry[0] == token):
+            self._tokens.pop(key, None)
+        if token is not None:
+            self._rejected[key] = token
+
+    async def get(self, key: str, fetch: TokenFetcher) -> str:
+        entry = self._tokens.get(key)
+        if self._usable(entry, self.min_validity):
+            if not self._usable(entry, self.refresh_margin):
+                self._refresh_in_background(key, fetch)
+            metrics.token_cache.inc(result="hit")
+            return entry[0]
+        async with self._lock(key):
+            entry = self._tokens.get(key)
+            if self._usable(entry, self.min_validity):
+                # Refreshed by whoever held the lock before us.
+                metrics.token_cache.inc(result="hit")
+                return entry[0]
+            return await self._refresh(key, fetch)
+
+    def _refresh_in_background(self, key: str, fetch: TokenFetcher) -> None:
+        task = self._background.get(key)
+        if task and not task.done():
+            return
+
+        async def run():
+            async with self._lock(key):
+                if not self._usable(self._tokens.get(key), self.refresh_margin):
+                    await self._refresh(key, fetch)
+
+        task = self._background[key] = asyncio.create_task(run())
+        # A failed proactive refresh is retried by the next caller.
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    async def _refresh(self, key: str, fetch: TokenFetcher) -> str:
+        if self._store is None:
+            return await self._fetch(key, fetch)
+
+        entry = await asyncio.to_thread(self._store.get, key)
+        if self._usable_shared(key, entry):
+            metrics.token_cache.inc(result="shared")
+            self._tokens[key] = entry
+            return entry[0]
+
+        if not await asyncio.to_thread(self._store.acquire_lease, key, self.lease_ttl):
+            # Another worker is fetching; wait for it to publish the token.
+            deadline = time.time() + self.lease_ttl
+            while time.time() < deadline:
+                await asyncio.sleep(0.05)
+                entry = await asyncio.to_thread(self._store.get, key)
+                if self._usable_shared(key, entry):
+                    metrics.token_cache.inc(result="shared")
+                    self._tokens[key] = entry
+                    return entry[0]
+
+        try:
+            token = await self._fetch(key, fetch)
+        except Exception:
+            await asyncio.to_thread(self._store.release_lease, key)
+            raise
+        await asyncio.to_thread(self._store.put, key, *self._tokens[key])
+        return token
+
+    async def _fetch(self, key: str, fetch: TokenFetcher) -> str:
+        metrics.token_cache.inc(result="miss")
+        token, expires_in = await fetch()
+        self._tokens[key] = (token, time.time() + expires_in)
+        return token
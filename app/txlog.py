@@ -0,0 +1,107 @@
+import asyncio
+import datetime
+import logging
+from typing import Any, Dict, List, Optional
+
+from .batching import STOP, collect_batch
+from .db import DEFAULT_CURRENCY, add_payment_transactions
+
+logger = logging.getLogger(__name__)
+
+DURABILITY_ASYNC = "async"  # log() returns as soon as the record is queued
+DURABILITY_ACK = "ack"      # log() returns once the record is committed
+
+
+class TransactionLogger:
+    # Write-behind logger for PaymentTransaction rows. Records are queued in
+    # memory and written by one background task in multi-row inserts, once
+    # batch_size records are waiting or flush_interval seconds have passed.
+    def __init__(
+        self,
+        *,
+        batch_size: int = 200,
+        flush_interval: float = 0.5,
+        max_queue: int = 10000,
+        durability: str = DURABILITY_ASYNC,
+    ):
+        if durability not in (DURABILITY_ASYNC, DURABILITY_ACK):
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.durability = durability
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        await self._queue.put(STOP)
+        await self._task
+        self._task = None
+        self._queue = None
+
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    async def log(
+        self,
+        order_id,
+        amount,
+        description,
+        status,
+        idempotency_key=None,
+        redirect_uri=None,
+        pos_id=None,
+        currency=DEFAULT_CURRENCY,
+    ) -> None:
+        row = {
+            "order_id": order_id,
+            "amount": amount,
+            "currency": currency,
+            "description": description,
+            "status": status,
+            "created_at": datetime.datetime.utcnow(),
+            "idempotency_key": idempotency_key,
+            "redirect_uri": redirect_uri,
+            "pos_id": pos_id,
+        }
+        if self._task is None or idempotency_key:
+            # Write through when not running inside the app lifespan, and for
+            # keyed rows whatever the durability mode: other workers find a
+            # key's order only in the database, so it must be committed before
+            # the response. The DB writer still group-commits them.
+            await asyncio.to_thread(add_payment_transactions, [row])
+            return
+        ack = None
+        if self.durability == DURABILITY_ACK:
+            ack = asyncio.get_running_loop().create_future()
+        await self._queue.put((row, ack))
+        if ack is not None:
+            await ack
+
+    async def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            batch, stopping = await collect_batch(self._queue, self.batch_size, self.flush_interval)
+            if batch:
+                await self._flush(batch)
+
+    async def _flush(self, batch: List[tuple]) -> None:
+        rows: List[Dict[str, Any]] = [row for row, _ in batch]
+        try:
+            await asyncio.to_thread(add_payment_transactions, rows)
+        except Exception as e:
+            logger.exception("Failed to write %d payment transactions", len(rows))
+            for _, ack in batch:
+                if ack is not None and not ack.done():
+                    ack.set_exception(e)
+            return
+        for _, ack in batch:
+            if ack is not None and not ack.done():
+                ack.set_result(None)
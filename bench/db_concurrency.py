@@ -0,0 +1,160 @@
+# Write-contention check for the SQLite storage layer (app/db.py).
+#
+#   python -m bench.db_concurrency --processes 4 --threads 8 --seconds 10
+#
+# Runs several processes (like uvicorn workers), each with many threads that
+# insert transactions, apply status updates and take leases as fast as they
+# can while other threads page through the transaction list. Everything runs
+# against a fresh settings.db in a scratch directory, which every process
+# starts by migrating (init_db) at the same moment. Prints a JSON report
+# with per-operation counts, error counts and latency percentiles; exits
+# non-zero if any "database is locked" (or other) errors were raised.
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OPERATIONS = ("insert", "update", "lease", "read")
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 2)
+
+
+def worker(index, workdir, threads, seconds, batch, results):
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    from app import db
+    from app.notify import should_apply
+
+    db.init_db()
+
+    stats = {op: {"ok": 0, "errors": 0, "locked": 0, "latencies": []} for op in OPERATIONS}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def record(op, started, error=None):
+        with lock:
+            entry = stats[op]
+            entry["latencies"].append(time.perf_counter() - started)
+            if error is None:
+                entry["ok"] += 1
+            else:
+                entry["errors"] += 1
+                if "locked" in str(error) or "busy" in str(error):
+                    entry["locked"] += 1
+
+    def run(thread):
+        rng = random.Random(f"{index}:{thread}")
+        seq = 0
+        while time.monotonic() < deadline:
+            op = rng.choice(OPERATIONS)
+            started = time.perf_counter()
+            try:
+                if op == "insert":
+                    now = datetime.datetime.utcnow()
+                    db.add_payment_transactions([
+                        {
+                            "order_id": f"p{index}t{thread}n{seq + i}",
+                            "amount": rng.randint(100, 10000),
+                            "description": "bench",
+                            "status": "SUCCESS",
+                            "created_at": now,
+                        }
+                        for i in range(batch)
+                    ])
+                    seq += batch
+                elif op == "update":
+                    if seq:
+                        order_id = f"p{index}t{thread}n{rng.randrange(seq)}"
+                        db.apply_order_statuses({order_id: rng.choice(["PENDING", "COMPLETED"])}, should_apply)
+                elif op == "lease":
+                    db.acquire_lease("bench", f"{index}:{thread}", 1.0)
+                else:
+                    db.get_transactions_page(limit=50)
+            except Exception as e:
+                record(op, started, e)
+            else:
+                record(op, started)
+
+    pool = [threading.Thread(target=run, args=(t,)) for t in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    db.writer.stop()
+    results.put(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent read/write check for the SQLite storage layer.")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8, help="threads per process")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--batch", type=int, default=1, help="rows per insert call")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="payu-dbbench-")
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    try:
+        procs = [
+            ctx.Process(target=worker, args=(i, workdir, args.threads, args.seconds, args.batch, results))
+            for i in range(args.processes)
+        ]
+        for p in procs:
+            p.start()
+        merged = {op: {"ok": 0, "errors": 0, "locked": 0, "latencies": []} for op in OPERATIONS}
+        for _ in procs:
+            for op, entry in results.get().items():
+                for field in ("ok", "errors", "locked"):
+                    merged[op][field] += entry[field]
+                merged[op]["latencies"].extend(entry["latencies"])
+        for p in procs:
+            p.join()
+
+        import sqlite3
+        with sqlite3.connect(os.path.join(workdir, "settings.db")) as conn:
+            rows = conn.execute("SELECT COUNT(*) FROM payment_transactions").fetchone()[0]
+            rollup_rows = conn.execute("SELECT COALESCE(SUM(orders), 0) FROM revenue_rollups").fetchone()[0]
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "processes": args.processes,
+        "threads": args.threads,
+        "seconds": args.seconds,
+        "rows": rows,
+        "rollups_consistent": rows == rollup_rows,
+        "operations": {
+            op: {
+                "ok": entry["ok"],
+                "errors": entry["errors"],
+                "locked": entry["locked"],
+                "per_s": round(entry["ok"] / args.seconds, 1),
+                "p50_ms": percentile(entry["latencies"], 0.50),
+                "p99_ms": percentile(entry["latencies"], 0.99),
+            }
+            for op, entry in merged.items()
+        },
+    }
+    print(json.dumps(report, indent=2))
+    if any(entry["errors"] for entry in merged.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# Local stand-in for the PayU OAuth and orders endpoints, for benchmarks.
+#
+#   STUB_LATENCY_MS=80 STUB_ERROR_RATE=0.01 STUB_TOKEN_TTL=300 \
+#     uvicorn bench.payu_stub:app --port 8900
+import asyncio
+import os
+import random
+import secrets
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "50"))
+JITTER_MS = float(os.getenv("STUB_JITTER_MS", "10"))
+ERROR_RATE = float(os.getenv("STUB_ERROR_RATE", "0"))
+TOKEN_TTL = int(os.getenv("STUB_TOKEN_TTL", "43199"))
+# Status reported by GET /api/v2_1/orders/{orderId}, as if the buyer paid.
+ORDER_STATUS = os.getenv("STUB_ORDER_STATUS", "COMPLETED")
+
+app = FastAPI(title="PayU stub")
+
+tokens = {}  # access_token -> expiry (time.time())
+orders = {}  # orderId -> status
+stats = {"oauth": 0, "orders": 0, "order_lookups": 0, "errors": 0, "unauthorized": 0}
+
+
+async def simulate():
+    delay = max(0.0, LATENCY_MS + random.uniform(-JITTER_MS, JITTER_MS)) / 1000
+    await asyncio.sleep(delay)
+    if ERROR_RATE and random.random() < ERROR_RATE:
+        stats["errors"] += 1
+        return JSONResponse({"status": {"statusCode": "ERROR_INTERNAL"}}, status_code=503)
+    return None
+
+
+def authorized(request: Request) -> bool:
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+    if tokens.get(token, 0) > time.time():
+        return True
+    stats["unauthorized"] += 1
+    return False
+
+
+@app.post("/pl/standard/user/oauth/authorize")
+async def oauth(request: Request):
+    stats["oauth"] += 1
+    error = await simulate()
+    if error:
+        return error
+    token = secrets.token_hex(16)
+    tokens[token] = time.time() + TOKEN_TTL
+    return {"access_token": token, "token_type": "bearer", "expires_in": TOKEN_TTL, "grant_type": "client_credentials"}
+
+
+@app.post("/api/v2_1/orders")
+async def create_order(request: Request):
+    stats["orders"] += 1
+    if not authorized(request):
+        return JSONResponse({"status": {"statusCode": "UNAUTHORIZED"}}, status_code=401)
+    error = await simulate()
+    if error:
+        return error
+    order_id = uuid.uuid4().hex[:20].upper()
+    orders[order_id] = "NEW"
+    return JSONResponse(
+        {
+            "status": {"statusCode": "SUCCESS"},
+            "redirectUri": f"https://merch-prod.snd.payu.com/pay/?orderId={order_id}",
+            "orderId": order_id,
+        },
+        status_code=302,
+    )
+
+
+@app.get("/api/v2_1/orders/{order_id}")
+async def get_order(order_id: str, request: Request):
+    stats["order_lookups"] += 1
+    if not authorized(request):
+        return JSONResponse({"status": {"statusCode": "UNAUTHORIZED"}}, status_code=401)
+    error = await simulate()
+    if error:
+        return error
+    if order_id not in orders:
+        return JSONResponse({"status": {"statusCode": "DATA_NOT_FOUND"}}, status_code=404)
+    orders[order_id] = ORDER_STATUS
+    return {
+        "orders": [{"orderId": order_id, "status": orders[order_id]}],
+        "status": {"statusCode": "SUCCESS"},
+    }
+
+
+@app.get("/_stats")
+async def get_stats():
+    return {**stats, "orders_created": len(orders)}
@@ -0,0 +1,256 @@
+# Load test for the app against the local PayU stub (bench/payu_stub.py).
+#
+#   python -m bench.run --concurrency 1,8,32 --requests 500 --output bench.json
+#
+# Starts the stub and the app (in a scratch directory, so settings.db is
+# fresh), configures the app through the admin panel, drives /pay,
+# /payu/notify and /admin/transactions at each concurrency level, and prints
+# a JSON report with latency percentiles, throughput and DB row counts.
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADMIN_PASSWORD = "bench"
+SECOND_KEY = "bench-second-key"
+SCENARIOS = ("pay", "notify", "admin")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(target, port, workers, cwd, env):
+    cmd = [
+        sys.executable, "-m", "uvicorn", target,
+        "--host", "127.0.0.1", "--port", str(port),
+        "--workers", str(workers), "--log-level", "warning",
+    ]
+    return subprocess.Popen(cmd, cwd=cwd, env=env)
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+async def wait_ready(url, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+async def drive(name, concurrency, total, send):
+    latencies = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            start = time.perf_counter()
+            try:
+                ok = await send(i)
+            except httpx.HTTPError:
+                ok = False
+            latencies.append((time.perf_counter() - start) * 1000)
+            if not ok:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "scenario": name,
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 2),
+            "p95": round(percentile(latencies, 95), 2),
+            "p99": round(percentile(latencies, 99), 2),
+            "max": round(latencies[-1], 2),
+            "mean": round(sum(latencies) / len(latencies), 2),
+        },
+    }
+
+
+def signed_notification(order_id, status):
+    body = json.dumps({"order": {"orderId": order_id, "status": status}}).encode()
+    signature = hashlib.md5(body + SECOND_KEY.encode()).hexdigest()
+    header = f"sender=checkout;signature={signature};algorithm=MD5;content=DOCUMENT"
+    return body, {"OpenPayU-Signature": header, "Content-Type": "application/json"}
+
+
+def db_counts(db_file):
+    if not os.path.exists(db_file):
+        return {}
+    conn = sqlite3.connect(db_file)
+    try:
+        total = conn.execute("SELECT COUNT(*) FROM payment_transactions").fetchone()[0]
+        by_status = dict(conn.execute(
+            "SELECT status, COUNT(*) FROM payment_transactions GROUP BY status ORDER BY 2 DESC LIMIT 20"
+        ).fetchall())
+    finally:
+        conn.close()
+    return {"payment_transactions": total, "by_status": by_status}
+
+
+def known_order_ids(db_file, limit=10000):
+    if not os.path.exists(db_file):
+        return []
+    conn = sqlite3.connect(db_file)
+    try:
+        rows = conn.execute(
+            "SELECT order_id FROM payment_transactions WHERE order_id IS NOT NULL LIMIT ?", (limit,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return [r[0] for r in rows]
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="payu-bench-")
+    stub_port, app_port = free_port(), free_port()
+    stub_url = f"http://127.0.0.1:{stub_port}"
+    app_url = f"http://127.0.0.1:{app_port}"
+    env = dict(os.environ)
+    env["PYTHONPATH"] = REPO_ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    stub_env = dict(
+        env,
+        STUB_LATENCY_MS=str(args.latency_ms),
+        STUB_ERROR_RATE=str(args.error_rate),
+        STUB_TOKEN_TTL=str(args.token_ttl),
+    )
+    app_env = dict(env, PAYU_BASE_URL=stub_url)
+
+    stub = start_server("bench.payu_stub:app", stub_port, 1, REPO_ROOT, stub_env)
+    server = start_server("app.main:app", app_port, args.workers, workdir, app_env)
+    results = []
+    try:
+        await wait_ready(stub_url + "/_stats")
+        await wait_ready(app_url + "/")
+        limits = httpx.Limits(max_connections=max(args.concurrency) + 10)
+        async with httpx.AsyncClient(base_url=app_url, limits=limits, timeout=60) as client:
+            # First login sets the admin password.
+            await client.post("/admin/login", data={"password": ADMIN_PASSWORD})
+            await client.post("/admin", data={
+                "pos_id": "300746",
+                "client_secret": "bench-client-secret",
+                "second_key": SECOND_KEY,
+                "app_base_url": app_url,
+            })
+            # Let every worker notice the new settings.
+            await asyncio.sleep(1.5)
+
+            async def pay(i):
+                r = await client.post("/pay", data={"amount_pln": "12.34", "description": f"bench {i}"})
+                return r.status_code == 303
+
+            order_ids = []
+            statuses = ("PENDING", "COMPLETED")
+
+            async def notify(i):
+                order_id = order_ids[i % len(order_ids)] if order_ids else f"BENCH{i}"
+                body, headers = signed_notification(order_id, statuses[(i // max(1, len(order_ids))) % 2])
+                r = await client.post("/payu/notify", content=body, headers=headers)
+                return r.status_code == 200
+
+            async def admin(i):
+                params = {"status": "SUCCESS"} if i % 2 else {}
+                r = await client.get("/admin/transactions", params=params)
+                return r.status_code == 200
+
+            senders = {"pay": pay, "notify": notify, "admin": admin}
+            for scenario in args.scenarios:
+                if scenario == "notify":
+                    order_ids = known_order_ids(os.path.join(workdir, "settings.db"))
+                for concurrency in args.concurrency:
+                    results.append(await drive(scenario, concurrency, args.requests, senders[scenario]))
+        stub_stats = httpx.get(stub_url + "/_stats").json()
+    finally:
+        # SIGTERM runs the app lifespan shutdown, which flushes pending writes.
+        stop_server(server)
+        stop_server(stub)
+
+    report = {
+        "config": {
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "workers": args.workers,
+            "stub_latency_ms": args.latency_ms,
+            "stub_error_rate": args.error_rate,
+            "stub_token_ttl": args.token_ttl,
+        },
+        "results": results,
+        "db": db_counts(os.path.join(workdir, "settings.db")),
+        "stub": stub_stats,
+    }
+    if args.keep:
+        report["workdir"] = workdir
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test PayU Starter against a local PayU stub.")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario and level")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--token-ttl", type=int, default=300)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    args = parser.parse_args()
+    args.concurrency = [int(c) for c in args.concurrency.split(",")]
+    args.scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()